@@ -0,0 +1,80 @@
+"""
+Measure how long archive-chan takes to start.
+
+    python benchmarks/startup.py [--repeat N]
+
+Reports the wall time of `archive-chan --help` in a fresh interpreter, and how
+long a pool worker takes from being spawned to resolving its first thread url,
+for each of the `fork` and `spawn` start methods.
+"""
+import subprocess
+import sys
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from statistics import median
+from time import perf_counter
+from typing import Callable, List
+
+HEAVY_MODULES = ["flask", "jinja2", "requests", "superjson"]
+THREAD_URL = "https://boards.4chan.org/g/thread/79745590"
+
+
+def resolve_thread_url(thread_url: str) -> str:
+    from archive_chan.extractors import Extractor
+
+    class_, thread = Extractor.match_url(thread_url)
+    return f"{class_.__name__} /{thread.board}/{thread.tid}"
+
+
+def time_cli_help() -> float:
+    start = perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "archive_chan", "--help"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return perf_counter() - start
+
+
+def time_worker_spawn(start_method: str) -> Callable[[], float]:
+    def run() -> float:
+        start = perf_counter()
+        with get_context(start_method).Pool(processes=1) as pool:
+            pool.apply(resolve_thread_url, (THREAD_URL,))
+        return perf_counter() - start
+
+    return run
+
+
+def heavy_modules_imported_by_cli() -> List[str]:
+    code = (
+        "import sys, archive_chan.archiver;"
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    return output.stdout.split()
+
+
+def report(name: str, benchmark: Callable[[], float], repeat: int):
+    timings = [benchmark() for _ in range(repeat)]
+    print(
+        f"{name:<24} min {min(timings) * 1000:8.1f} ms"
+        f"   median {median(timings) * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark archive-chan's startup time.")
+    parser.add_argument("--repeat", default=10, type=int, help="Runs per benchmark.")
+    args = parser.parse_args()
+    heavy_modules = heavy_modules_imported_by_cli()
+    print("Heavy modules imported at startup:", " ".join(heavy_modules) or "none")
+    report("archive-chan --help", time_cli_help, args.repeat)
+    report("worker spawn (fork)", time_worker_spawn("fork"), args.repeat)
+    report("worker spawn (spawn)", time_worker_spawn("spawn"), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,8 +35,16 @@ setuptools.setup(
         "console_scripts": [
             "archive-chan=archive_chan:main",
             "archive-chan-build-index=thread_indexer:main",
+            "archive-chan-export=thread_indexer.columnar_export:main",
+            "archive-chan-pack=archive_chan.storage:main",
+            "archive-chan-serve=archive_chan.server:main",
         ],
     },
     python_requires=">=3.7",
     install_requires=requirements,
+    extras_require={
+        "analytics": ["numpy"],
+        "brotli": ["brotli"],
+        "thumbnails": ["Pillow"],
+    },
 )
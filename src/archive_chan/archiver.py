@@ -1,55 +1,142 @@
+import json
+from argparse import Namespace
+from functools import partial
 from multiprocessing import Pool
 from pathlib import Path
-from time import time
-from typing import Callable, List, Optional, Sequence, TypeVar
+from queue import Queue
+from time import sleep, strftime, time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
 
-from toolz import compose
-
-from .extractors import Extractor, FourChanAPIE
+from .extractors import Extractor, FourChanAPIE, ThreadGoneError
+from .journal import JOURNAL_FILENAME, Journal, LeaseHeartbeat, get_worker_id
 from .models import boards
 from .params import get_args
+from .profiling import PARTS_FOLDER, StackSampler, merge_profiles
+from .utils import is_compression_available, safely_create_dir
 
 T = TypeVar("T")
 U = TypeVar("U")
 OptionalConcreteExtractor = Optional[FourChanAPIE]
 path_to_download: Path = Path("/tmp/")
+POLL_INTERVAL = 10  # seconds between claims while other workers hold the leases
 
 
 def choose_extractor(thread_url: str) -> OptionalConcreteExtractor:
-    """Check for valid urls in Extractor subclasses."""
-    thread = None
-    extractor: OptionalConcreteExtractor = None
-    for class_ in Extractor.__subclasses__():
-        thread = class_.parse_thread_url(thread_url)
-        if thread:
-            extractor = class_(thread)
-            # TODO: this path_to_download does not belong here
-            break
-    return extractor
+    """Find the registered extractor for the url and instantiate it."""
+    # TODO: this path_to_download does not belong here
+    return Extractor.from_url(thread_url)
 
 
-def download_text_data(extractor: OptionalConcreteExtractor):
+def download_text_data(extractor: OptionalConcreteExtractor) -> Optional[str]:
     if extractor is not None:
         try:
             extractor.download_thread_data()
+        except ThreadGoneError:
+            raise  # not worth a retry; see attempt_stage
         except RuntimeError as e:
             print(repr(e))
+            return repr(e)
+    return None
 
 
-def download_media_files(extractor: OptionalConcreteExtractor):
+def download_media_files(extractor: OptionalConcreteExtractor) -> Optional[str]:
     if extractor is not None:
         try:
             extractor.download_thread_media()
         except Exception as e:
             print(repr(e))
+            return repr(e)
+    return None
+
+
+def download_thumbnails(extractor: OptionalConcreteExtractor) -> Optional[str]:
+    if extractor is not None:
+        try:
+            extractor.download_thread_thumbnails()
+        except Exception as e:
+            print(repr(e))
+            return repr(e)
+    return None
 
 
-def render_threads(extractor: OptionalConcreteExtractor):
+def render_threads(extractor: OptionalConcreteExtractor) -> Optional[str]:
     if extractor is not None:
         try:
             extractor.render_thread()
         except Exception as e:
-            raise e
+            print(repr(e))
+            return repr(e)
+    return None
+
+
+STAGES: Dict[str, Callable[[OptionalConcreteExtractor], Optional[str]]] = {
+    "text": download_text_data,
+    "media": download_media_files,
+    "thumbs": download_thumbnails,
+    "render": render_threads,
+}
+
+
+def attempt_stage(
+    stage: str, thread_url: str, sampler: Optional[StackSampler] = None
+) -> Tuple[Optional[str], bool, List[str]]:
+    """
+    Run the stage and return its error, whether the error is final, and the
+    files that could not be downloaded.
+    """
+    extractor = None
+    try:
+        extractor = choose_extractor(thread_url)
+        if sampler is not None and extractor is not None:
+            sampler.prefix[1] = f"/{extractor.thread.board}/{extractor.thread.tid}"
+        error, final = STAGES[stage](extractor), False
+    except ThreadGoneError as e:
+        print(repr(e))
+        error, final = repr(e), True
+    except Exception as e:
+        # e.g. a truncated thread.json; it is retried like a failed download
+        print(repr(e))
+        error, final = repr(e), False
+    failed_files = extractor.failed_downloads if extractor is not None else []
+    return error, final, failed_files
+
+
+def run_stage(
+    stage: str,
+    journal: Journal,
+    run_id: Optional[int],
+    thread_url: str,
+    profile_folder: Optional[Path] = None,
+) -> Optional[str]:
+    """Run one stage for one thread and record its outcome in the journal."""
+    if profile_folder is None:
+        error, final, failed_files = attempt_stage(stage, thread_url)
+    else:
+        with StackSampler(profile_folder, [stage, thread_url]) as sampler:
+            error, final, failed_files = attempt_stage(stage, thread_url, sampler)
+    journal.record(run_id, thread_url, stage, error, failed_files, final)
+    return error
+
+
+def get_stages(args: Namespace) -> List[str]:
+    stages = ["text"]
+    if not args.text_only:
+        if args.preserve_media:
+            stages.append("media")
+        else:
+            # TODO: download op media only
+            pass
+        if not args.skip_thumbnails:
+            stages.append("thumbs")
+    # TODO: parse posts' text
+    if not args.skip_renders:
+        stages.append("render")
+    return stages
+
+
+def get_run_key(args: Namespace, stages: List[str]) -> str:
+    """Identify runs which an interrupted one can be resumed by."""
+    return json.dumps([args.thread, args.archived, args.archived_only, stages])
 
 
 def feeder(url: str, archived: bool, archived_only: bool, verbose: bool) -> List[str]:
@@ -73,11 +160,14 @@ def feeder(url: str, archived: bool, archived_only: bool, verbose: bool) -> List
 def safe_parallel_run(
     func: Callable[[T], U], sequence: Sequence[T], threads: int = 8
 ) -> Sequence[U]:
+    if not sequence:
+        return []
     if len(sequence) < threads:
         threads = len(sequence)
     with Pool(processes=threads) as pool:
         try:
-            res = pool.map(func, sequence)
+            # one at a time, so that the sequence's order is the processing order
+            res = pool.map(func, sequence, chunksize=1)
         except KeyboardInterrupt:
             print("Killing downloads...")
             pool.terminate()
@@ -85,25 +175,155 @@ def safe_parallel_run(
     return res
 
 
+def claim_work(
+    journal: Journal,
+    run_id: int,
+    thread_urls: List[str],
+    stages: List[str],
+    owner: str,
+    count: int,
+) -> List[Tuple[str, str]]:
+    """
+    Lease up to `count` (stage, thread url) pairs of the run that are ready.
+
+    Earlier stages come first: fetching a thread's posts is quick and they are
+    what is lost when it is pruned, and rendering, which is local and can wait,
+    must never keep a worker from downloading. Within a stage, threads are taken
+    in the order of `thread_urls`, the ones closest to being pruned first.
+    """
+    claimed: List[Tuple[str, str]] = []
+    for previous_stage, stage in zip([None, *stages], stages):
+        if len(claimed) >= count:
+            break
+        batch = journal.claim(
+            run_id,
+            stage,
+            thread_urls,
+            owner,
+            count - len(claimed),
+            after=previous_stage,
+        )
+        claimed.extend((stage, url) for url in batch)
+    return claimed
+
+
+def work_on_run(
+    journal: Journal,
+    run_id: int,
+    thread_urls: List[str],
+    stages: List[str],
+    verbose: bool,
+    profile_folder: Optional[Path] = None,
+    threads: int = 8,
+):
+    """
+    Lease the run's threads until every stage is done for all of them.
+
+    A thread is only claimed for a stage once it went through the previous one,
+    possibly in another worker; see `claim_work` for which work goes first.
+    Work is only claimed when a worker of the pool is free to start it.
+    """
+    owner = get_worker_id()
+    journal.release_dead_leases()
+    threads = max(min(threads, len(thread_urls)), 1)
+    outcomes: "Queue[object]" = Queue()
+    in_flight = 0
+    with Pool(processes=threads) as pool, LeaseHeartbeat(journal, owner):
+        try:
+            while True:
+                free = threads - in_flight
+                for stage, url in claim_work(
+                    journal, run_id, thread_urls, stages, owner, free
+                ):
+                    if verbose:
+                        print(f"{stage}: claimed {url}")
+                    pool.apply_async(
+                        run_stage,
+                        (stage, journal, run_id, url),
+                        {"profile_folder": profile_folder},
+                        callback=outcomes.put,
+                        error_callback=outcomes.put,
+                    )
+                    in_flight += 1
+                if in_flight:
+                    outcome = outcomes.get()
+                    in_flight -= 1
+                    if isinstance(outcome, BaseException):
+                        raise outcome
+                elif journal.is_run_complete(run_id, stages, thread_urls):
+                    break
+                else:
+                    if verbose:
+                        print("Waiting for other workers to finish their threads.")
+                    sleep(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print("Killing downloads...")
+            pool.terminate()
+            exit(1)
+    journal.finish_run(run_id)
+
+
+def retry_failed(
+    journal: Journal, stages: List[str], profile_folder: Optional[Path] = None
+):
+    """
+    Rerun the stages that failed in previous runs and whose backoff is over.
+
+    Threads whose retry succeeds go on through the later `stages`, which their
+    failure held back.
+    """
+    owner = get_worker_id()
+    journal.release_dead_leases()
+    due = journal.due_dead_letters()
+    print(f"Retrying {len(due)} failed thread stages.")
+    recovered: List[str] = []
+    with LeaseHeartbeat(journal, owner):
+        for stage in STAGES:
+            thread_urls = [url for url, failed_stage in due if failed_stage == stage]
+            if stage in stages:
+                thread_urls = list(dict.fromkeys([*recovered, *thread_urls]))
+            # threads another process is working on are left to it
+            thread_urls = journal.lease(stage, thread_urls, owner)
+            errors = safe_parallel_run(
+                partial(run_stage, stage, journal, None, profile_folder=profile_folder),
+                thread_urls,
+            )
+            recovered = [url for url in recovered if url not in thread_urls] + [
+                url for url, error in zip(thread_urls, errors) if error is None
+            ]
+
+
 def main():
     start_time = time()
     args = get_args()
     global path_to_download
     path_to_download = args.path
-    thread_urls = feeder(args.thread, args.archived, args.archived_only, args.verbose)
-    if thread_urls:
-        # download all jsons/htmls/text only
-        safe_parallel_run(compose(download_text_data, choose_extractor), thread_urls)
-        if not args.text_only:
-            if args.preserve_media:
-                # download all media
-                safe_parallel_run(
-                    compose(download_media_files, choose_extractor), thread_urls
-                )
-            else:
-                # TODO: download op media only
-                pass
-        # TODO: parse posts' text
-        if not args.skip_renders:
-            safe_parallel_run(compose(render_threads, choose_extractor), thread_urls)
+    safely_create_dir(args.path)
+    if not all(map(is_compression_available, args.compress_html)):
+        print("brotli is not installed; rendered pages will not be saved as .br.")
+    journal = Journal(args.path / JOURNAL_FILENAME)
+    profile_folder = None
+    if args.profile:
+        profile_folder = args.path / "profiles" / strftime("%Y%m%d-%H%M%S")
+    stages = get_stages(args)
+    if args.retry_failed:
+        retry_failed(journal, stages, profile_folder)
+    else:
+        run_id, thread_urls = journal.start_run(
+            get_run_key(args, stages),
+            partial(
+                feeder, args.thread, args.archived, args.archived_only, args.verbose
+            ),
+            resume=not args.no_resume,
+            max_age=args.resume_within * 60 * 60,
+        )
+        work_on_run(journal, run_id, thread_urls, stages, args.verbose, profile_folder)
+    failed_stages, failed_files = journal.count_dead_letters()
+    if failed_stages:
+        print(
+            f"{failed_stages} failed thread stages ({failed_files} media files)"
+            " are queued; retry them with --retry_failed."
+        )
+    if profile_folder is not None and (profile_folder / PARTS_FOLDER).is_dir():
+        print(f"Profile written to {merge_profiles(profile_folder)}.")
     print("Time elapsed: %.4fs" % (time() - start_time))
@@ -1,2 +1,2 @@
-from .extractor import Extractor
+from .extractor import Extractor, ThreadGoneError
 from .fourchan_api import FourChanAPIE
@@ -1,47 +1,197 @@
 import re
 import sys
 from abc import ABC, abstractmethod
+from argparse import Namespace
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Optional
-
-from requests.exceptions import RequestException
-from flask import Flask, render_template
+from typing import (
+    TYPE_CHECKING,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+    Type,
+)
 
 from ..models import Thread
 from ..params import get_args
-from ..safe_requests_session import RetrySession
+from ..utils import (
+    COMPRESSED_SUFFIXES,
+    atomic_path,
+    compressed_writer,
+    is_compression_available,
+    remove_file,
+)
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+# Flask, requests and superjson are imported where they are first needed, so that
+# the command-line interface and freshly spawned pool workers start quickly.
+_app: Optional["Flask"] = None
+
+
+def get_app() -> "Flask":
+    """Return this process' Flask app, which is only used to render templates."""
+    global _app
+    if _app is None:
+        from flask import Flask
+
+        _app = Flask("archive-chan", template_folder="./assets/templates/")
+        # TODO: fix this relative path; what if user runs outside of repo root?
+    return _app
+
+
+_indentation = re.compile(r"\s*\n\s*")
+
+
+def minify_html(chunks: Iterable[str]) -> Iterator[str]:
+    """Strip indentation, trailing spaces and blank lines out of a stream of HTML."""
+    # whitespace at the end of a chunk may be indentation continued by the next one
+    pending = ""
+    for chunk in chunks:
+        # chunks may be Markup, which would escape anything added to them
+        chunk = "".join((pending, chunk))
+        content = chunk.rstrip()
+        pending = chunk[len(content) :]
+        if content:
+            yield _indentation.sub("\n", content)
+    yield _indentation.sub("\n", pending)
+
+
+class ThreadGoneError(RuntimeError):
+    """The thread 404'd before anything of it was saved; retrying will not help."""
+
+
+def _prefix_groups(pattern: str, prefix: str) -> str:
+    """Rename the named groups of `pattern` so patterns can be joined together."""
+    pattern = re.sub(r"\(\?P<(\w+)>", rf"(?P<{prefix}\1>", pattern)
+    return re.sub(r"\(\?P=(\w+)\)", rf"(?P={prefix}\1)", pattern)
 
 
 class Extractor(ABC):
     VALID_URL = r""
+    _valid_url: Pattern = re.compile(VALID_URL)
+    _registry: List[Type["Extractor"]] = []
+    _combined_valid_url: Optional[Pattern] = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._valid_url = re.compile(cls.VALID_URL)
+        if cls.VALID_URL:
+            Extractor._registry.append(cls)
+            Extractor._combined_valid_url = None
 
-    def __init__(self, thread: Thread):
+    @staticmethod
+    def _get_combined_valid_url() -> Pattern:
+        """Compile every extractor's VALID_URL into a single alternation."""
+        if Extractor._combined_valid_url is None:
+            Extractor._combined_valid_url = re.compile(
+                "|".join(
+                    f"(?P<_{i}>{_prefix_groups(class_.VALID_URL, f'_{i}_')})"
+                    for i, class_ in enumerate(Extractor._registry)
+                )
+            )
+        return Extractor._combined_valid_url
+
+    @staticmethod
+    def match_url(thread_url: str) -> Optional[Tuple[Type["Extractor"], Thread]]:
+        """Find the extractor for `thread_url` with a single regex match."""
+        match_ = Extractor._get_combined_valid_url().match(thread_url)
+        if not match_ or match_.lastgroup is None:
+            return None
+        # the outermost group of the matching alternative is the last one closed
+        index = match_.lastgroup
+        class_ = Extractor._registry[int(index[1:])]
+        return class_, class_._thread_from_match(match_, thread_url, f"{index}_")
+
+    @classmethod
+    def from_url(
+        cls, thread_url: str, args: Optional[Namespace] = None
+    ) -> Optional["Extractor"]:
+        matched = cls.match_url(thread_url)
+        if matched is None:
+            return None
+        class_, thread = matched
+        return class_(thread, args)
+
+    def __init__(self, thread: Thread, args: Optional[Namespace] = None):
         super().__init__()
         self.thread = thread
 
-        args = get_args()
+        if args is None:
+            args = get_args()
         self.archive_path = args.path
         self.verbose = args.verbose
+        self.posts_per_page = args.posts_per_page
+        self.local_thumbnails = args.local_thumbnails
+        self.minify_html = args.minify_html
+        self.compress_html = [
+            encoding
+            for encoding in args.compress_html
+            if is_compression_available(encoding)
+        ]
+        self.failed_downloads: List[str] = []
+        self.missing_files: List[str] = []
 
-        self.app = Flask("archive-chan", template_folder="./assets/templates/")
-        # TODO: fix this relative path; what if user runs outside of repo root?
+    @property
+    def app(self) -> "Flask":
+        return get_app()
+
+    @staticmethod
+    def _thread_from_match(match_: Match, thread_url: str, prefix: str = "") -> Thread:
+        board = match_.group(f"{prefix}board")
+        thread_id = match_.group(f"{prefix}thread")
+        # TODO: what about the chan name? e.g., 8ch, 55chan, 4channel
+        return Thread(thread_id, board, thread_url)
 
     @classmethod
     def parse_thread_url(cls, thread_url: str) -> Optional[Thread]:
-        match_ = re.match(cls.VALID_URL, thread_url)
+        match_ = cls._valid_url.match(thread_url)
         if not match_:
             return None
-        board = match_.group("board")
-        thread_id = match_.group("thread")
-        # TODO: what about the chan name? e.g., 8ch, 55chan, 4channel
-        thread = Thread(thread_id, board, thread_url)
-        return thread
+        return cls._thread_from_match(match_, thread_url)
 
-    def render_and_save_html(self, output_path: Path, **kwargs):
+    def stream_html(self, **kwargs) -> Iterator[str]:
+        """Render the thread template piece by piece instead of as a whole."""
         with self.app.app_context():
-            rendered = render_template("thread.html", **kwargs)
-            with open(output_path, "w", encoding="utf-8") as html_file:
-                html_file.write(rendered)
+            template = self.app.jinja_env.get_template("thread.html")
+            self.app.update_template_context(kwargs)
+            yield from template.generate(**kwargs)
+
+    def render_html(self, **kwargs) -> str:
+        return "".join(self.stream_html(**kwargs))
+
+    def render_and_save_html(self, output_path: Path, **kwargs):
+        """
+        Stream the rendered page into `output_path` and its compressed siblings.
+
+        Every file is written under a temporary name and only replaces the old one
+        once the whole page has been rendered. Compressed siblings left over from
+        earlier renders are removed then, so they never outlive the page.
+        """
+        chunks = self.stream_html(**kwargs)
+        if self.minify_html:
+            chunks = minify_html(chunks)
+        with ExitStack() as stack:
+            writers = []
+            for encoding in [None, *self.compress_html]:
+                suffix = COMPRESSED_SUFFIXES.get(encoding, "")
+                file_path = output_path.with_name(output_path.name + suffix)
+                temp_path = stack.enter_context(atomic_path(file_path))
+                writers.append(
+                    stack.enter_context(compressed_writer(temp_path, encoding))
+                )
+            for chunk in chunks:
+                data = chunk.encode("utf-8")
+                for write in writers:
+                    write(data)
+            for encoding, suffix in COMPRESSED_SUFFIXES.items():
+                if encoding not in self.compress_html:
+                    remove_file(output_path.with_name(output_path.name + suffix))
 
     def download_file(
         self,
@@ -55,8 +205,14 @@ class Extractor(ABC):
         """
         Donwload file from `url` to `file_path`.
 
-        If it fails, retry until total retries reached.
+        If it fails, retry until total retries reached. Urls that could not be
+        downloaded are kept in `failed_downloads`, and those that are gone from the
+        server in `missing_files`.
         """
+        from requests.exceptions import RequestException
+
+        from ..safe_requests_session import RetrySession
+
         requests_session = RetrySession()
         try:
             if not skip_check and file_path.is_file():
@@ -69,19 +225,20 @@ class Extractor(ABC):
             response = requests_session.get(url, timeout=16)
             if response.status_code == 404:
                 print(f"{url} could not be found on server.")
+                self.missing_files.append(url)
                 return
-            with open(file_path, "wb") as output:
-                output.write(response.content)
+            with atomic_path(file_path) as temp_path:
+                with open(temp_path, "wb") as output:
+                    output.write(response.content)
         except RequestException as e:
             print(e, file=sys.stderr)
-            if num_retry > max_retries:
-                print(f"Retry #{num_retry}...")
+            if num_retry < max_retries:
                 num_retry += 1
+                print(f"Retry #{num_retry}...")
                 self.download_file(url, file_path, verbose, max_retries, num_retry)
             else:
-                m = f"Giving up on {url}; error {response.status_code}."
-                print(m, file=sys.stderr)
-
+                print(f"Giving up on {url}.", file=sys.stderr)
+                self.failed_downloads.append(url)
 
     @abstractmethod
     def download_thread_data():
@@ -91,6 +248,10 @@ class Extractor(ABC):
     def download_thread_media():
         pass
 
+    @abstractmethod
+    def download_thread_thumbnails():
+        pass
+
     @abstractmethod
     def render_thread():
         pass
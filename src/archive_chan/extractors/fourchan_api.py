@@ -1,15 +1,21 @@
 import os
+import re
+from argparse import Namespace
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import List, Optional
-
-import requests
-from superjson import json
+from typing import Collection, Dict, List, Optional
 
 from ..models import Reply, Thread
-from ..safe_requests_session import RetrySession
-from ..utils import count_files_in_dir, safely_create_dir
-from .extractor import Extractor
+from ..scheduler import ThreadListing, prioritize
+from ..storage import ThreadStorage, get_pack_path, open_thread_storage
+from ..utils import (
+    atomic_path,
+    count_files_in_dir,
+    remove_file,
+    safely_create_dir,
+)
+from .extractor import Extractor, ThreadGoneError
 
 
 @dataclass
@@ -20,16 +26,22 @@ class MediaInfo:
 
     def __post_init__(self):
         self.filename = f"{self.tim}{self.ext}"
+        self.thumbnail_filename = f"{self.tim}s.jpg"
 
 
 class FourChanAPIE(Extractor):
     VALID_URL = r"https?://boards.(4channel|4chan).org/(?P<board>[\w-]+)/thread/(?P<thread>[0-9]+)"
     base_thread_url = "https://boards.4chan.org/{board}/thread/{thread_id}"
     base_media_url = "https://i.4cdn.org/{}/{}"
+    thumbnailable_exts = {".jpg", ".png", ".gif"}
+    default_thumbnail_size = (250, 250)
+    page_file_pattern = re.compile(r"(?P<page>index-[0-9]+\.html)(\.gz|\.br)?")
+    quotelink_pattern = re.compile(r'<a href="#p(?P<no>[0-9]+)" class="quotelink">')
 
-    def __init__(self, thread: Thread):
-        super().__init__(thread)
+    def __init__(self, thread: Thread, args: Optional[Namespace] = None):
+        super().__init__(thread, args)
         self._thread_data: Optional[dict] = None
+        self._storage: Optional[ThreadStorage] = None
 
     @property
     def thread_data(self) -> Optional[dict]:
@@ -37,6 +49,20 @@ class FourChanAPIE(Extractor):
             self._thread_data = self._load_previous_thread_data()
         return self._thread_data
 
+    @property
+    def storage(self) -> ThreadStorage:
+        if self._storage is None:
+            self._storage = open_thread_storage(
+                self.archive_path, self.thread.board, self.thread.tid
+            )
+        return self._storage
+
+    @property
+    def is_packed(self) -> bool:
+        return get_pack_path(
+            self.archive_path, self.thread.board, self.thread.tid
+        ).is_file()
+
     @property
     def thread_folder(self) -> Path:
         return self.archive_path.joinpath(self.thread.board, self.thread.tid)
@@ -47,6 +73,12 @@ class FourChanAPIE(Extractor):
         safely_create_dir(path)
         return path
 
+    @property
+    def thread_thumbnails_folder(self) -> Path:
+        path = self.thread_folder / "thumbs"
+        safely_create_dir(path)
+        return path
+
     @property
     def json_path(self) -> Path:
         return self.thread_folder / "thread.json"
@@ -57,6 +89,10 @@ class FourChanAPIE(Extractor):
 
     @staticmethod
     def get_thread_data(board: str, thread_id: str) -> Optional[dict]:
+        import requests
+
+        from ..safe_requests_session import RetrySession
+
         r = RetrySession().get(
             f"https://a.4cdn.org/{board}/thread/{thread_id}.json", timeout=16
         )
@@ -69,8 +105,12 @@ class FourChanAPIE(Extractor):
         return r.json()
 
     def _load_previous_thread_data(self) -> Optional[dict]:
+        if self.is_packed:
+            return self.storage.load_json()
         if not self.json_path.is_file():
             return None
+        from superjson import json
+
         return json.load(str(self.json_path), verbose=self.verbose)
 
     def _has_new_replies(self, previous_thread_data, current_thread_data):
@@ -98,15 +138,18 @@ class FourChanAPIE(Extractor):
             return False
 
     def _dump_thread_json(self, thread_data):
-        json.dump(
-            thread_data,
-            str(self.json_path),
-            indent=2,
-            sort_keys=True,
-            ensure_ascii=False,
-            overwrite=True,
-            verbose=self.verbose,
-        )
+        from superjson import json
+
+        with atomic_path(self.json_path) as temp_path:
+            json.dump(
+                thread_data,
+                str(temp_path),
+                indent=2,
+                sort_keys=True,
+                ensure_ascii=False,
+                overwrite=True,
+                verbose=self.verbose,
+            )
 
     def _mark_thread_as_404(self):
         if "archive-chan" not in self.thread_data:
@@ -116,12 +159,14 @@ class FourChanAPIE(Extractor):
         self._dump_thread_json(self.thread_data)
 
     def download_thread_data(self):
-        safely_create_dir(self.thread_folder)
+        import requests
+
         if self.thread_data is not None:
             if self._was_thread_archived() or self._was_thread_404():
                 if self.verbose:
                     print("Nothing new will ever be available again.")
                 return
+        safely_create_dir(self.thread_folder)
         try:
             self.current_thread_data = self.get_thread_data(
                 self.thread.board, self.thread.tid
@@ -131,7 +176,7 @@ class FourChanAPIE(Extractor):
         if self.current_thread_data is None:
             if self.thread_data is None:
                 # R.I.P.
-                raise RuntimeError("Thread 79244239 is 404. :(")
+                raise ThreadGoneError(f"Thread {self.thread.tid} is 404. :(")
             else:
                 self._mark_thread_as_404()
         elif self._has_new_replies(self.thread_data, self.current_thread_data):
@@ -163,7 +208,7 @@ class FourChanAPIE(Extractor):
 
     def _is_media_ok(self) -> bool:
         try:
-            if self.thread_data["archive-chan"]["media-ok"]:
+            if self.thread_data["archive-chan"]["media-done"]:
                 return True
         except KeyError:
             pass
@@ -180,10 +225,12 @@ class FourChanAPIE(Extractor):
 
     def _get_hash_mismatches(self) -> List[MediaInfo]:
         media_info_objs = self.get_media_info(self.thread_data["posts"])
+        # files that are gone from the server were never saved
         mismatched_hash_files = [
             media_file
             for media_file in media_info_objs
-            if media_file.md5
+            if (self.thread_media_folder / media_file.filename).is_file()
+            and media_file.md5
             != self.calculate_md5(self.thread_media_folder / media_file.filename)
         ]
         return mismatched_hash_files
@@ -217,6 +264,11 @@ class FourChanAPIE(Extractor):
                     self.verbose,
                     max_retries,
                 )
+            if self.failed_downloads:
+                msg = f"Could not download {len(self.failed_downloads)} media files."
+                raise RuntimeError(msg)
+            if self.missing_files and self.verbose:
+                print(f"{len(self.missing_files)} media files are gone for good.")
         # check if the downloaded files are ok
         # TODO: walrus when py38, can't py38 yet because superjson time.clock
         mismatched_hash_files = self._get_hash_mismatches()
@@ -234,30 +286,179 @@ class FourChanAPIE(Extractor):
                 self._mark_thread_media_as_done()
             return
 
+    def _make_thumbnail(self, post: dict, media: MediaInfo) -> bool:
+        """Shrink the local copy of an image into its thumbnail; needs Pillow."""
+        media_path = self.thread_folder / "media" / media.filename
+        if media.ext not in self.thumbnailable_exts or not media_path.is_file():
+            return False
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Pillow is needed to make thumbnails locally.")
+            return False
+        size = (post.get("tn_w"), post.get("tn_h"))
+        if not all(size):
+            size = self.default_thumbnail_size
+        thumbnail_path = self.thread_thumbnails_folder / media.thumbnail_filename
+        with Image.open(media_path) as image:
+            image.thumbnail(size)
+            with atomic_path(thumbnail_path) as temp_path:
+                image.convert("RGB").save(temp_path, "JPEG", quality=80)
+        return True
+
+    def _thumbnail_url(self, media: MediaInfo) -> str:
+        return self.base_media_url.format(self.thread.board, media.thumbnail_filename)
+
+    def _fetch_thumbnail(self, media: MediaInfo, max_retries: int) -> bool:
+        thumbnail_path = self.thread_thumbnails_folder / media.thumbnail_filename
+        self.download_file(
+            self._thumbnail_url(media), thumbnail_path, self.verbose, max_retries
+        )
+        return thumbnail_path.is_file()
+
+    def download_thread_thumbnails(self, max_retries: int = 3):
+        """
+        Fetch the thumbnail of every post's file from the CDN or, with
+        `local_thumbnails`, make it from the downloaded file instead.
+
+        Thumbnails that already exist are skipped, and whichever source is
+        not preferred is used as a fallback. Thumbnails that are gone from the
+        CDN do not fail the stage, as pages show the full file instead.
+        """
+        if self.thread_data is None or self.is_packed:
+            return
+        existing = {p.name for p in self.thread_thumbnails_folder.iterdir()}
+        for post in self.thread_data["posts"]:
+            if "tim" not in post:
+                continue
+            media = MediaInfo(post["tim"], post["ext"], post.get("md5", ""))
+            if media.thumbnail_filename in existing:
+                continue
+            fetch = partial(self._fetch_thumbnail, media, max_retries)
+            make = partial(self._make_thumbnail, post, media)
+            sources = (make, fetch) if self.local_thumbnails else (fetch, make)
+            if any(source() for source in sources):
+                # a failed fetch does not matter if the thumbnail was made instead
+                url = self._thumbnail_url(media)
+                for urls in (self.failed_downloads, self.missing_files):
+                    if url in urls:
+                        urls.remove(url)
+        if self.missing_files and self.verbose:
+            print(f"{len(self.missing_files)} thumbnails are gone for good.")
+        if self.failed_downloads:
+            msg = f"Could not download {len(self.failed_downloads)} thumbnails."
+            raise RuntimeError(msg)
+
     @staticmethod
-    def _assemble_Reply_from_post(post: dict, board: str) -> Reply:
+    def _assemble_Reply_from_post(
+        post: dict, board: str, thumbnails: Collection[str] = ()
+    ) -> Reply:
         post["board"] = board
         if "tim" in post:
             media_filename: str = f"{post['tim']}{post['ext']}"
             post["img_src"] = f"media/{media_filename}"
+            thumbnail_filename = f"{post['tim']}s.jpg"
+            if thumbnail_filename in thumbnails:
+                post["thumb_src"] = f"thumbs/{thumbnail_filename}"
+            else:
+                post["thumb_src"] = post["img_src"]
         return Reply(post)
 
+    @classmethod
+    def _collect_backlinks(cls, replies: List[Reply]):
+        """Fill each reply's `backlinks` with the numbers of the posts quoting it."""
+        backlinks: Dict[int, List[int]] = {r.no: r.backlinks for r in replies}
+        for reply in replies:
+            quoted_posts = dict.fromkeys(
+                int(no) for no in cls.quotelink_pattern.findall(reply.com)
+            )
+            for quoted in quoted_posts:
+                if quoted in backlinks:
+                    backlinks[quoted].append(reply.no)
+
+    @staticmethod
+    def _page_filename(page_number: int) -> str:
+        if page_number == 1:
+            return "index.html"
+        return f"index-{page_number}.html"
+
+    def _paginate(self, replies: List[Reply]) -> List[List[Reply]]:
+        if not self.posts_per_page or len(replies) <= self.posts_per_page:
+            return [replies]
+        return [
+            replies[i : i + self.posts_per_page]
+            for i in range(0, len(replies), self.posts_per_page)
+        ]
+
+    @classmethod
+    def _link_quotes_across_pages(cls, reply: Reply, locations: Dict[int, str]):
+        """Point quotelinks to posts on other pages at the page holding them."""
+        page = locations[reply.no]
+
+        def relink(match) -> str:
+            target = locations.get(int(match["no"]), page)
+            if target == page:
+                return match[0]
+            return match[0].replace('href="#p', f'href="{target}#p', 1)
+
+        reply.com = cls.quotelink_pattern.sub(relink, reply.com)
+
+    def page_contexts(self) -> Dict[str, dict]:
+        """Map each page's filename to the variables `thread.html` is rendered with."""
+        posts = self.thread_data["posts"]
+        thumbnails = set(self.storage.list("thumbs"))
+        replies = [
+            self._assemble_Reply_from_post(p, self.thread.board, thumbnails)
+            for p in posts
+        ]
+        self._collect_backlinks(replies)
+        op, replies = replies[0], replies[1:]
+        pages = self._paginate(replies)
+        page_filenames = [self._page_filename(n) for n in range(1, len(pages) + 1)]
+        # the OP is shown on every page, so it is left out of `locations`
+        locations = {
+            reply.no: filename
+            for filename, page in zip(page_filenames, pages)
+            for reply in page
+        }
+        if len(pages) > 1:
+            for reply in replies:
+                self._link_quotes_across_pages(reply, locations)
+        return {
+            filename: dict(
+                thread=self.thread,
+                op=op,
+                replies=page,
+                page=filename,
+                pages=page_filenames,
+                locations=locations,
+            )
+            for filename, page in zip(page_filenames, pages)
+        }
+
     def render_thread(self):
         # TODO:
         # check if thread.json has been modified since last render
-        posts = self.thread_data["posts"]
-        replies = [self._assemble_Reply_from_post(p, self.thread.board) for p in posts]
-        self.render_and_save_html(
-            self.html_page_path,
-            thread=self.thread,
-            op=replies[0],
-            replies=replies[1:],
-        )
+        if self.is_packed:
+            # its pages were packed along with it and cannot become outdated
+            if self.verbose:
+                print(f"Thread {self.thread.tid} is packed; not rendering it.")
+            return
+        contexts = self.page_contexts()
+        for filename, context in contexts.items():
+            self.render_and_save_html(self.thread_folder / filename, **context)
+        # remove pages left over from a render with fewer posts per page
+        for path in self.thread_folder.glob("index-*.html*"):
+            match_ = self.page_file_pattern.fullmatch(path.name)
+            if match_ and match_.group("page") not in contexts:
+                remove_file(path)
         if self.verbose:
             print(f"Rendered HTML page at {self.html_page_path}")
 
     @classmethod
     def _get_archived_threads_from_board(cls, board: str, verbose: bool) -> List[str]:
+        from ..safe_requests_session import RetrySession
+
         api_url = f"https://a.4cdn.org/{board}/archive.json"
         r = RetrySession().get(api_url)
         if r.status_code != 200:
@@ -274,17 +475,26 @@ class FourChanAPIE(Extractor):
 
     @classmethod
     def _get_active_threads_from_board(cls, board: str, verbose: bool) -> List[str]:
-        api_url = f"https://a.4cdn.org/{board}/threads.json"
+        """List the board's threads, those about to be pruned first."""
+        from ..safe_requests_session import RetrySession
+
+        api_url = f"https://a.4cdn.org/{board}/catalog.json"
         r = RetrySession().get(api_url)
         if r.status_code != 200:
             msg = f"Couldn't retrieve {board}'s active thread list."
             raise Exception(msg)
         data = r.json()
-        thread_urls = [
-            cls.base_thread_url.format(board=board, thread_id=thread["no"])
-            for page in data
-            for thread in page["threads"]
+        # the catalog's pages, and the threads in each, are in bump order
+        threads = [thread for page in data for thread in page["threads"]]
+        listings = [
+            ThreadListing.from_catalog(
+                cls.base_thread_url.format(board=board, thread_id=thread["no"]),
+                thread,
+                position,
+            )
+            for position, thread in enumerate(threads)
         ]
+        thread_urls = [listing.url for listing in prioritize(listings)]
         if verbose:
             print(f"Found {len(thread_urls)} active threads.")
         return thread_urls
@@ -0,0 +1,361 @@
+"""
+Persistent record of archiving runs, kept in a SQLite file inside the archive.
+
+A run remembers its thread urls and which of them went through each stage
+(text, media, render), so a recently interrupted run can be resumed instead
+of redone. Threads that fail a stage, and media files that could not be
+downloaded, go to a dead-letter queue from where they are retried later with
+backoff, until they run out of attempts. A failed stage holds back the
+thread's later stages. Failures that no retry can fix, like a thread that
+404'd before it was ever saved, are recorded as final instead.
+
+The journal is also a work queue: every process started with the same input
+on the same archive joins the same run and leases batches of threads from it.
+Leases are taken on a thread's stage, whatever the run, so processes archiving
+overlapping sets of threads never work on the same thread folder at once.
+They are renewed by a heartbeat and expire if their worker dies, so several
+processes, or hosts sharing the archive's filesystem, never duplicate work.
+"""
+import json
+import os
+import socket
+import sqlite3
+from contextlib import contextmanager
+from itertools import islice
+from math import inf
+from pathlib import Path
+from threading import Event, Thread, get_ident
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+JOURNAL_FILENAME = "journal.sqlite3"
+RETRY_BACKOFF = 10 * 60  # seconds before the first retry
+MAX_RETRY_BACKOFF = 24 * 60 * 60
+MAX_RETRY_ATTEMPTS = 8
+LEASE_TIME = 5 * 60  # seconds a claimed thread stays reserved without a heartbeat
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    urls TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS progress (
+    run_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (run_id, url, stage)
+);
+CREATE TABLE IF NOT EXISTS thread_leases (
+    url TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (url, stage)
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    url TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    error TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    retry_at REAL NOT NULL,
+    PRIMARY KEY (url, stage)
+);
+CREATE TABLE IF NOT EXISTS failed_files (
+    url TEXT PRIMARY KEY,
+    thread_url TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# one connection per process, thread and journal; sqlite connections must not
+# be shared with forked pool workers or across threads
+_connections: Dict[Tuple[int, int, str], sqlite3.Connection] = {}
+
+
+def backoff(attempts: int) -> float:
+    return min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Journal:
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        key = (os.getpid(), get_ident(), str(self.db_path))
+        if key not in _connections:
+            connection = sqlite3.connect(
+                str(self.db_path), timeout=60, isolation_level=None
+            )
+            connection.executescript(SCHEMA)
+            _connections[key] = connection
+        return _connections[key]
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def start_run(
+        self,
+        key: str,
+        get_urls: Callable[[], List[str]],
+        resume: bool = True,
+        max_age: float = inf,
+    ) -> Tuple[int, List[str]]:
+        """
+        Join the last unfinished run started with the same `key` in the last
+        `max_age` seconds, or start one.
+
+        `get_urls` is only called when a new run is started.
+        """
+        if resume:
+            run = self._find_unfinished_run(key, max_age)
+            if run is not None:
+                return run
+        urls = list(dict.fromkeys(get_urls()))
+        with self.transaction():
+            # another process may have started the same run in the meantime
+            run = self._find_unfinished_run(key, max_age) if resume else None
+            if run is None:
+                cursor = self.connection.execute(
+                    "INSERT INTO runs (key, urls, started) VALUES (?, ?, ?)",
+                    (key, json.dumps(urls), time()),
+                )
+                run = cursor.lastrowid, urls
+        return run
+
+    def _find_unfinished_run(
+        self, key: str, max_age: float
+    ) -> Optional[Tuple[int, List[str]]]:
+        row = self.connection.execute(
+            "SELECT id, urls FROM runs WHERE key = ? AND finished IS NULL"
+            " AND started >= ? ORDER BY id DESC LIMIT 1",
+            (key, time() - max_age),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def finish_run(self, run_id: int):
+        self.connection.execute(
+            "UPDATE runs SET finished = ? WHERE id = ? AND finished IS NULL",
+            (time(), run_id),
+        )
+
+    def _processed(
+        self, run_id: int, stage: str, status: Optional[str] = None
+    ) -> Set[str]:
+        query = "SELECT url FROM progress WHERE run_id = ? AND stage = ?"
+        params: Tuple = (run_id, stage)
+        if status is not None:
+            query += " AND status = ?"
+            params += (status,)
+        return {url for (url,) in self.connection.execute(query, params)}
+
+    def claim(
+        self,
+        run_id: int,
+        stage: str,
+        urls: Sequence[str],
+        owner: str,
+        count: int,
+        after: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Lease up to `count` of the run's `urls` that still need `stage`.
+
+        Threads leased by another live worker are skipped, and so are those that
+        have not successfully gone through the `after` stage yet.
+        """
+        with self.transaction():
+            processed = self._processed(run_id, stage)
+            ready = None if after is None else self._processed(run_id, after, "done")
+            candidates = [
+                url
+                for url in urls
+                if url not in processed and (ready is None or url in ready)
+            ]
+            return self._lease(stage, candidates, owner, count)
+
+    def lease(self, stage: str, urls: Sequence[str], owner: str) -> List[str]:
+        """Lease `stage` of those of `urls` that no live worker is working on."""
+        with self.transaction():
+            return self._lease(stage, urls, owner, len(urls))
+
+    def _lease(
+        self, stage: str, urls: Sequence[str], owner: str, count: int
+    ) -> List[str]:
+        now = time()
+        leased = {
+            url
+            for (url,) in self.connection.execute(
+                "SELECT url FROM thread_leases WHERE stage = ? AND expires > ?",
+                (stage, now),
+            )
+        }
+        batch = list(islice((url for url in urls if url not in leased), count))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO thread_leases VALUES (?, ?, ?, ?)",
+            [(url, stage, owner, now + LEASE_TIME) for url in batch],
+        )
+        return batch
+
+    def renew_leases(self, owner: str):
+        self.connection.execute(
+            "UPDATE thread_leases SET expires = ? WHERE owner = ?",
+            (time() + LEASE_TIME, owner),
+        )
+
+    def release_dead_leases(self):
+        """Free the leases of this host's workers that are no longer running."""
+        host = socket.gethostname()
+        owners = self.connection.execute(
+            "SELECT DISTINCT owner FROM thread_leases WHERE owner LIKE ?",
+            (f"{host}:%",),
+        ).fetchall()
+        for (owner,) in owners:
+            if not is_process_alive(int(owner.rsplit(":", 1)[1])):
+                self.connection.execute(
+                    "DELETE FROM thread_leases WHERE owner = ?", (owner,)
+                )
+
+    def is_run_complete(
+        self, run_id: int, stages: Sequence[str], urls: Sequence[str]
+    ) -> bool:
+        """Check that every thread went through every stage, or stopped at one."""
+        stages_done: Dict[str, int] = dict.fromkeys(urls, 0)
+        stopped = set()
+        for url, status in self.connection.execute(
+            "SELECT url, status FROM progress WHERE run_id = ?", (run_id,)
+        ):
+            if status == "done":
+                stages_done[url] = stages_done.get(url, 0) + 1
+            else:
+                stopped.add(url)
+        return all(url in stopped or stages_done[url] >= len(stages) for url in urls)
+
+    def record(
+        self,
+        run_id: Optional[int],
+        url: str,
+        stage: str,
+        error: Optional[str] = None,
+        failed_files: Iterable[str] = (),
+        final: bool = False,
+    ):
+        """
+        Store the outcome of `stage` for `url`, dead-lettering it on `error`.
+
+        A `final` error is not worth retrying and is not dead-lettered.
+        """
+        now = time()
+        if error is None:
+            status = "done"
+        else:
+            status = "final" if final else "failed"
+        with self.transaction():
+            if run_id is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?)",
+                    (run_id, url, stage, status, now),
+                )
+            self.connection.execute(
+                "DELETE FROM thread_leases WHERE url = ? AND stage = ?", (url, stage)
+            )
+            if status != "failed":
+                self.connection.execute(
+                    "DELETE FROM dead_letters WHERE url = ? AND stage = ?",
+                    (url, stage),
+                )
+            else:
+                row = self.connection.execute(
+                    "SELECT attempts FROM dead_letters WHERE url = ? AND stage = ?",
+                    (url, stage),
+                ).fetchone()
+                attempts = 1 if row is None else row[0] + 1
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?)",
+                    (url, stage, error, attempts, now + backoff(attempts)),
+                )
+            if stage == "media":
+                failed_files = list(failed_files)
+                self.connection.execute(
+                    "DELETE FROM failed_files WHERE thread_url = ? AND url NOT IN"
+                    f" ({', '.join('?' * len(failed_files))})",
+                    (url, *failed_files),
+                )
+                self.connection.executemany(
+                    "INSERT INTO failed_files VALUES (?, ?, 1, ?)"
+                    " ON CONFLICT (url) DO UPDATE SET"
+                    " attempts = attempts + 1, updated = excluded.updated",
+                    [(file_url, url, now) for file_url in failed_files],
+                )
+
+    def due_dead_letters(self) -> List[Tuple[str, str]]:
+        """Return the (url, stage) pairs whose retry time has come."""
+        return self.connection.execute(
+            "SELECT url, stage FROM dead_letters WHERE retry_at <= ? AND attempts < ?"
+            " ORDER BY retry_at",
+            (time(), MAX_RETRY_ATTEMPTS),
+        ).fetchall()
+
+    def count_dead_letters(self) -> Tuple[int, int]:
+        """Return how many thread stages and media files are waiting for a retry."""
+        (threads,) = self.connection.execute(
+            "SELECT COUNT(*) FROM dead_letters WHERE attempts < ?",
+            (MAX_RETRY_ATTEMPTS,),
+        ).fetchone()
+        (files,) = self.connection.execute(
+            "SELECT COUNT(*) FROM failed_files WHERE attempts < ?",
+            (MAX_RETRY_ATTEMPTS,),
+        ).fetchone()
+        return threads, files
+
+
+class LeaseHeartbeat(Thread):
+    """Keep renewing `owner`'s leases in the background while in a `with` block."""
+
+    def __init__(self, journal: Journal, owner: str, interval: float = LEASE_TIME / 3):
+        super().__init__(daemon=True)
+        self.journal = journal
+        self.owner = owner
+        self.interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.journal.renew_leases(self.owner)
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self.join()
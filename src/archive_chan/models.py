@@ -126,7 +126,9 @@ class Reply:
         self.tail_size = 0
 
         self.img_src = ""
+        self.thumb_src = ""
         self.board = ""
+        self.backlinks = []
         self.custom_id = str(post["no"]) + str(post["time"])
 
         allowed_keys = list(self.__dict__.keys())
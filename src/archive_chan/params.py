@@ -1,12 +1,15 @@
 from argparse import ArgumentParser
 from pathlib import Path
+from typing import List, Optional
 
 
-def get_args():
-    """Get user input from the command-line and parse it."""
+def get_args(argv: Optional[List[str]] = None):
+    """Get user input from the command-line, or from `argv`, and parse it."""
     parser = ArgumentParser(description="Archives 4chan threads")
     parser.add_argument(
-        "thread", help="Link to the 4chan thread or the name of the board."
+        "thread",
+        nargs="?",
+        help="Link to the 4chan thread or the name of the board.",
     )
     parser.add_argument(
         "-a",
@@ -32,12 +35,48 @@ def get_args():
         help="Path to folder where the threads should be saved.",
         type=Path,
     )
+    parser.add_argument(
+        "--compress_html",
+        choices=["gz", "br"],
+        default=[],
+        help="Also save each rendered page compressed in these formats, next to it "
+        "(br needs brotli).",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--local_thumbnails",
+        action="store_true",
+        help="Make thumbnails from the saved media (needs Pillow) instead of "
+        "fetching them from 4chan.",
+    )
+    parser.add_argument(
+        "--minify_html",
+        action="store_true",
+        help="Strip indentation and blank lines from rendered pages.",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Start over instead of resuming an interrupted run with the same input.",
+    )
     parser.add_argument(
         "--posts",
         default=None,
         help="Number of posts to download",
         type=int,
     )
+    parser.add_argument(
+        "--posts_per_page",
+        default=None,
+        help="Split rendered threads into pages of at most this many replies.",
+        type=int,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Sample every worker's stages and write a flame graph profile of the "
+        "run to <path>/profiles/.",
+    )
     parser.add_argument(
         "-r",
         "--retries",
@@ -45,11 +84,29 @@ def get_args():
         help="Retry -r times if a download fails.",
         type=int,
     )
+    parser.add_argument(
+        "--resume_within",
+        default=6,
+        help="Only resume interrupted runs started within this many hours, so a "
+        "board's stale thread list is not replayed (default: %(default)s).",
+        metavar="HOURS",
+        type=float,
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="Retry the threads that failed in previous runs and are due a retry.",
+    )
     parser.add_argument(
         "--skip_renders",
         action="store_true",
         help="Do not render thread HTMLs after downloading them.",
     )
+    parser.add_argument(
+        "--skip_thumbnails",
+        action="store_true",
+        help="Do not save thumbnails; rendered threads will show full-size media.",
+    )
     parser.add_argument(
         "--text_only",
         action="store_true",
@@ -66,5 +123,7 @@ def get_args():
         action="store_true",
         help="Verbose logging to stdout.",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.thread is None and not args.retry_failed:
+        parser.error("the following arguments are required: thread")
     return args
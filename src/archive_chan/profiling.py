@@ -0,0 +1,139 @@
+"""
+Sample the call stacks of pool workers and merge them into one profile.
+
+While a stage runs for a thread, a background thread of the worker records the
+worker's call stack every few milliseconds. The stacks are prefixed with the
+stage and the thread they were taken for, and appended to a file per worker
+process. Once the run is over the files are merged into `profile.folded`, the
+"folded stacks" format read by flamegraph.pl, speedscope and inferno, and into
+`hotspots.txt`, a summary of the busiest functions per stage and thread.
+"""
+import os
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+from threading import Event, Thread, get_ident
+from types import FrameType
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SAMPLING_INTERVAL = 0.005  # seconds
+PARTS_FOLDER = "parts"
+FOLDED_FILENAME = "profile.folded"
+HOTSPOTS_FILENAME = "hotspots.txt"
+TOP_FUNCTIONS = 20
+TOP_THREADS = 10
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def _stack_depth(frame: Optional[FrameType]) -> int:
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+class StackSampler(Thread):
+    """
+    Within a `with` block, sample the stack of the thread that entered it.
+
+    Frames from outside the block, such as the pool's machinery, are left out,
+    and `prefix` frames are put at the root of every stack when it is saved.
+    """
+
+    def __init__(self, profile_folder: Path, prefix: List[str]):
+        super().__init__(daemon=True)
+        self.profile_folder = profile_folder
+        self.prefix = prefix
+        self.samples: Counter = Counter()
+        self._stopped = Event()
+        self._target = get_ident()
+        self._base_depth = 0
+
+    def run(self):
+        while not self._stopped.wait(SAMPLING_INTERVAL):
+            frame = sys._current_frames().get(self._target)
+            frames = []
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+            # drop the frames that were already there when the block started
+            frames = frames[-self._base_depth - 1 :: -1]
+            if frames and frames[0].f_code is StackSampler.__exit__.__code__:
+                break  # the block is over
+            self.samples[";".join(map(_frame_name, frames))] += 1
+
+    def __enter__(self) -> "StackSampler":
+        # sampled stacks start right below the frame that entered the block
+        self._base_depth = _stack_depth(sys._getframe(1))
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self.join()
+        self.save()
+
+    def save(self):
+        parts_folder = self.profile_folder / PARTS_FOLDER
+        parts_folder.mkdir(parents=True, exist_ok=True)
+        prefix = ";".join(self.prefix)
+        with open(parts_folder / f"{os.getpid()}.folded", "a") as part:
+            for stack, count in self.samples.items():
+                if stack:
+                    part.write(f"{prefix};{stack} {count}\n")
+
+
+def read_folded(path: Path) -> Iterator[Tuple[str, int]]:
+    with open(path) as folded:
+        for line in folded:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            yield stack, int(count)
+
+
+def summarize(samples: Counter) -> str:
+    """List the busiest functions of each stage, and the busiest threads."""
+    by_stage: Dict[str, Counter] = defaultdict(Counter)
+    inclusive: Dict[str, Counter] = defaultdict(Counter)
+    by_thread: Counter = Counter()
+    for stack, count in samples.items():
+        stage, thread, *frames = stack.split(";")
+        if not frames:
+            continue
+        by_stage[stage][frames[-1]] += count
+        for frame in set(frames):
+            inclusive[stage][frame] += count
+        by_thread[f"{stage} {thread}"] += count
+    interval = SAMPLING_INTERVAL * 1000
+    lines = [f"{sum(samples.values())} samples, {interval:g} ms apart"]
+    for stage, functions in by_stage.items():
+        total = sum(functions.values())
+        lines += ["", f"[{stage}] {total} samples", "    self  total  function"]
+        for frame, count in functions.most_common(TOP_FUNCTIONS):
+            share, inclusive_share = count / total, inclusive[stage][frame] / total
+            lines.append(f"  {share:6.1%} {inclusive_share:6.1%}  {frame}")
+    lines += ["", "busiest threads"]
+    for thread, count in by_thread.most_common(TOP_THREADS):
+        lines.append(f"  {count:6d}  {thread}")
+    return "\n".join(lines) + "\n"
+
+
+def merge_profiles(profile_folder: Path) -> Path:
+    """Merge the workers' samples into the folded stacks and hotspots files."""
+    samples: Counter = Counter()
+    parts = sorted((profile_folder / PARTS_FOLDER).glob("*.folded"))
+    for part in parts:
+        for stack, count in read_folded(part):
+            samples[stack] += count
+    folded_path = profile_folder / FOLDED_FILENAME
+    with open(folded_path, "w") as folded:
+        for stack, count in sorted(samples.items()):
+            folded.write(f"{stack} {count}\n")
+    (profile_folder / HOTSPOTS_FILENAME).write_text(summarize(samples))
+    for part in parts:
+        part.unlink()
+    return folded_path
@@ -0,0 +1,87 @@
+"""
+Order a board's threads by how soon they are likely to be pruned.
+
+A board's catalog is sorted by bump order, and its last thread is the next one
+to fall off. Every new or bumped thread pushes the ones below it down by one
+place, so a thread's place in the catalog tells how much of the board has to
+turn over before it is pruned. The board turns over about once in the time its
+last thread has gone without a bump, so a thread's time left is that time
+scaled by the share of the board below it. `last_modified` is not trusted for
+anything else, as sage replies and replies past the bump limit change it too.
+Threads below the bump limit may still be bumped back to the top, which makes
+them safer the faster they are getting replies, so the estimate is stretched by
+the chance of at least one bump in that window.
+"""
+from dataclasses import dataclass
+from math import exp, inf
+from time import time
+from typing import List, Optional
+
+MIN_THREAD_AGE = 60  # seconds; keeps reply velocities of brand new threads sane
+IMAGE_LIMIT_SLOWDOWN = 0.5  # threads past the image limit get replies slower
+
+
+@dataclass
+class ThreadListing:
+    url: str
+    position: int  # place in the catalog's bump order, counted from the top
+    created: int
+    last_modified: int
+    replies: int = 0
+    bumplimit: bool = False
+    imagelimit: bool = False
+    sticky: bool = False
+
+    @classmethod
+    def from_catalog(cls, url: str, thread: dict, position: int) -> "ThreadListing":
+        return cls(
+            url=url,
+            position=position,
+            created=thread["time"],
+            last_modified=thread.get("last_modified", thread["time"]),
+            replies=thread.get("replies", 0),
+            bumplimit=bool(thread.get("bumplimit")),
+            imagelimit=bool(thread.get("imagelimit")),
+            sticky=bool(thread.get("sticky")),
+        )
+
+
+def estimate_time_to_expiry(
+    listing: ThreadListing, rank: int, board_size: int, lifetime: float, now: float
+) -> float:
+    """
+    Estimate in seconds how long `listing` stays on the board.
+
+    `rank` is its place among the board's `board_size` threads that can be
+    pruned, and `lifetime` is how long the board's last thread has gone without
+    a bump.
+    """
+    if listing.sticky:
+        return inf
+    left = lifetime * (board_size - rank) / board_size
+    if listing.bumplimit:
+        return left
+    velocity = listing.replies / max(now - listing.created, MIN_THREAD_AGE)
+    if listing.imagelimit:
+        velocity *= IMAGE_LIMIT_SLOWDOWN
+    bump_chance = 1 - exp(-velocity * left)
+    # a bump puts the thread back at the top, regaining the places it had sunk
+    return left + bump_chance * lifetime * rank / board_size
+
+
+def prioritize(
+    listings: List[ThreadListing], now: Optional[float] = None
+) -> List[ThreadListing]:
+    """Sort `listings` so that the threads closest to being pruned come first."""
+    if now is None:
+        now = time()
+    prunable = sorted((t for t in listings if not t.sticky), key=lambda t: t.position)
+    ranks = {t.url: rank for rank, t in enumerate(prunable)}
+    board_size = max(len(prunable), 1)
+    lifetime = max((now - t.last_modified for t in prunable), default=0)
+    return sorted(
+        listings,
+        key=lambda t: estimate_time_to_expiry(
+            t, ranks.get(t.url, 0), board_size, lifetime, now
+        ),
+    )
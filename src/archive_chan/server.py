@@ -0,0 +1,207 @@
+"""
+Serve an archive straight from the stored thread data.
+
+Thread pages are rendered on demand and kept in an LRU cache capped in bytes;
+a cached page is thrown away as soon as its `thread.json`, or the set of its
+thumbnails, changes on disk.
+Assets are served from precompressed `.br`/`.gz` siblings when the client
+accepts them, and media files support HTTP Range requests. Packed threads are
+served from inside their packs.
+"""
+import mimetypes
+from argparse import ArgumentParser, Namespace
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Hashable, Optional, Tuple
+
+from flask import Flask, abort, render_template, request, send_from_directory
+from werkzeug.wsgi import wrap_file
+
+from .extractors import FourChanAPIE
+from .models import Thread, boards
+from .storage import FolderStorage, StorageVersion
+
+CacheVersion = StorageVersion
+PRECOMPRESSED_ENCODINGS = {"br": ".br", "gzip": ".gz"}
+THREAD_FOLDERS = {"media", "thumbs"}
+
+
+def get_args():
+    """Get user input from the command-line and parse it."""
+    parser = ArgumentParser(description="Serve archived threads over HTTP.")
+    parser.add_argument(
+        "--path",
+        default="./threads/",
+        help="Path to folder where the threads are saved.",
+        type=Path,
+    )
+    parser.add_argument(
+        "--assets",
+        default="./assets/",
+        help="Path to archive-chan's assets folder.",
+        type=Path,
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", default=8000, help="Port to listen on.", type=int)
+    parser.add_argument(
+        "--cache_size",
+        default=256,
+        help="Maximum size of the rendered page cache in MiB.",
+        type=int,
+    )
+    parser.add_argument(
+        "--posts_per_page",
+        default=None,
+        help="Split rendered threads into pages of at most this many replies.",
+        type=int,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Verbose logging to stdout.",
+    )
+    # the server only reads thumbnails and renders pages in memory
+    parser.set_defaults(local_thumbnails=False, minify_html=False, compress_html=[])
+    args = parser.parse_args()
+    return args
+
+
+class ByteLRUCache:
+    """Least-recently-used cache whose capacity is the total size of its values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, Tuple[CacheVersion, bytes]]" = (
+            OrderedDict()
+        )
+        self._lock = Lock()
+
+    def get(self, key: Hashable, version: CacheVersion) -> Optional[bytes]:
+        """Return the cached value unless it is missing or from another version."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, version: CacheVersion, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (version, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: Hashable):
+        _, value = self._entries.pop(key)
+        self.size -= len(value)
+
+
+def send_precompressed(directory: Path, filename: str):
+    """Send `filename`, or its best precompressed sibling the client accepts."""
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    available = [
+        encoding
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS.items()
+        if (directory / f"{filename}{suffix}").is_file()
+    ]
+    encoding = request.accept_encodings.best_match(available)
+    if encoding is None:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+    else:
+        response = send_from_directory(
+            directory,
+            filename + PRECOMPRESSED_ENCODINGS[encoding],
+            mimetype=mimetype,
+        )
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def create_app(args: Namespace) -> Flask:
+    app = Flask(
+        "archive-chan",
+        static_folder=None,
+        template_folder=str(args.assets.resolve() / "templates"),
+    )
+    cache = ByteLRUCache(args.cache_size * 2 ** 20)
+
+    def load_extractor(board: str, tid: str) -> FourChanAPIE:
+        if board not in boards or not tid.isdigit():
+            abort(404)
+        url = FourChanAPIE.base_thread_url.format(board=board, thread_id=tid)
+        extractor = FourChanAPIE(Thread(tid, board, url), args)
+        if not extractor.storage.exists("thread.json"):
+            abort(404)
+        return extractor
+
+    @app.route("/assets/<path:filename>")
+    def assets(filename: str):
+        return send_precompressed(args.assets, filename)
+
+    @app.route("/<board>/<tid>/")
+    @app.route("/<board>/<tid>/<page>.html")
+    def thread_page(board: str, tid: str, page: str = "index"):
+        extractor = load_extractor(board, tid)
+        version = extractor.storage.version()
+        key = (board, tid, page)
+        html = cache.get(key, version)
+        if html is None:
+            context = extractor.page_contexts().get(f"{page}.html")
+            if context is None:
+                abort(404)
+            html = render_template("thread.html", **context).encode("utf-8")
+            cache.put(key, version, html)
+            if args.verbose:
+                print(f"Rendered /{board}/{tid}/{page}.html")
+        return html, {"Content-Type": "text/html; charset=utf-8"}
+
+    @app.route("/<board>/<tid>/<folder>/<filename>")
+    def thread_file(board: str, tid: str, folder: str, filename: str):
+        if folder not in THREAD_FOLDERS:
+            abort(404)
+        storage = load_extractor(board, tid).storage
+        name = f"{folder}/{filename}"
+        if not storage.exists(name):
+            abort(404)
+        # conditional responses include support for Range requests
+        if isinstance(storage, FolderStorage):
+            return send_from_directory(
+                storage.folder / folder, filename, conditional=True
+            )
+        # send_file cannot serve ranges of a stream, as it does not know its size
+        size = storage.size(name)
+        response = app.response_class(
+            wrap_file(request.environ, storage.open(name)),
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        response.last_modified = storage.pack_path.stat().st_mtime
+        response.cache_control.no_cache = True
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=size
+        )
+
+    return app
+
+
+def main():
+    args = get_args()
+    app = create_app(args)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
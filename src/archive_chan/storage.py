@@ -0,0 +1,274 @@
+"""
+Read access to a thread's files, whether they are in its folder or in a pack.
+
+Threads that can never change again, i.e. archived or 404'd threads whose media
+has been fully downloaded, can be packed into a single `<board>/<tid>.pack` file
+to save inodes and make backups and cold reads faster. A pack is an uncompressed
+zip: its central directory is the offset index, so any member can be read
+without going through the rest, and standard tools can still open it.
+"""
+import io
+import json
+import os
+import shutil
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Tuple
+from zipfile import ZIP_STORED, ZipFile
+
+from .utils import atomic_path
+
+PACK_SUFFIX = ".pack"
+LOCAL_HEADER_SIZE = 30  # bytes of a zip member's local header, before its name
+StorageVersion = Tuple[int, ...]
+
+
+class ThreadStorage(ABC):
+    """Files of one thread, addressed by their path relative to the thread folder."""
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def read_bytes(self, name: str) -> bytes:
+        pass
+
+    @abstractmethod
+    def list(self, folder: str) -> List[str]:
+        """Return the names of the files in `folder`."""
+
+    @abstractmethod
+    def version(self) -> StorageVersion:
+        """Return a value that changes whenever the thread's data changes."""
+
+    @abstractmethod
+    def content_version(self) -> StorageVersion:
+        """
+        Return a value that only changes when the content of `thread.json` does.
+
+        It is the same whether the thread is packed or not.
+        """
+
+    @abstractmethod
+    def stat_version(self) -> StorageVersion:
+        """
+        Return a value that is cheap to get and changes whenever
+        `content_version` may have, without reading `thread.json`.
+        """
+
+    def load_json(self) -> dict:
+        return json.loads(self.read_bytes("thread.json"))
+
+
+class FolderStorage(ThreadStorage):
+    def __init__(self, folder: Path):
+        self.folder = folder
+
+    def exists(self, name: str) -> bool:
+        return (self.folder / name).is_file()
+
+    def read_bytes(self, name: str) -> bytes:
+        return (self.folder / name).read_bytes()
+
+    def list(self, folder: str) -> List[str]:
+        path = self.folder / folder
+        if not path.is_dir():
+            return []
+        return [p.name for p in path.iterdir()]
+
+    def version(self) -> StorageVersion:
+        stat = (self.folder / "thread.json").stat()
+        thumbnails_folder = self.folder / "thumbs"
+        thumbnails_mtime = (
+            thumbnails_folder.stat().st_mtime_ns if thumbnails_folder.is_dir() else 0
+        )
+        return stat.st_mtime_ns, stat.st_size, thumbnails_mtime
+
+    def content_version(self) -> StorageVersion:
+        data = self.read_bytes("thread.json")
+        return zlib.crc32(data), len(data)
+
+    def stat_version(self) -> StorageVersion:
+        stat = (self.folder / "thread.json").stat()
+        return stat.st_mtime_ns, stat.st_size
+
+
+class MemberReader(io.RawIOBase):
+    """Seekable view of the bytes of a stored member, read from its pack."""
+
+    def __init__(self, pack_file: BinaryIO, start: int, size: int):
+        super().__init__()
+        self._pack_file = pack_file
+        self._start = start
+        self._position = 0
+        self.size = size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}
+        self._position = min(max(base[whence] + offset, 0), self.size)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        self._pack_file.seek(self._start + self._position)
+        left = self.size - self._position
+        read = self._pack_file.readinto(memoryview(buffer)[:left])
+        self._position += read
+        return read
+
+    def close(self):
+        self._pack_file.close()
+        super().close()
+
+
+class PackStorage(ThreadStorage):
+    def __init__(self, pack_path: Path):
+        self.pack_path = pack_path
+        with ZipFile(pack_path) as pack:
+            self._infos = {info.filename: info for info in pack.infolist()}
+
+    def exists(self, name: str) -> bool:
+        return name in self._infos
+
+    def read_bytes(self, name: str) -> bytes:
+        with ZipFile(self.pack_path) as pack:
+            return pack.read(self._infos[name])
+
+    def size(self, name: str) -> int:
+        return self._infos[name].file_size
+
+    def open(self, name: str) -> BinaryIO:
+        """Open a member for reading, without loading it into memory."""
+        info = self._infos[name]
+        if info.compress_type != ZIP_STORED:
+            # not written by pack_thread; slower to seek, as it is decompressed
+            return ZipFile(self.pack_path).open(info)
+        pack_file = open(self.pack_path, "rb")
+        # the member's bytes follow its local header, whose file name and extra
+        # field lengths are its last two fields
+        pack_file.seek(info.header_offset + LOCAL_HEADER_SIZE - 4)
+        name_length, extra_length = struct.unpack("<HH", pack_file.read(4))
+        start = info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+        return MemberReader(pack_file, start, info.file_size)
+
+    def list(self, folder: str) -> List[str]:
+        prefix = f"{folder}/"
+        return [
+            name[len(prefix) :]
+            for name in self._infos
+            if name.startswith(prefix) and "/" not in name[len(prefix) :]
+        ]
+
+    def version(self) -> StorageVersion:
+        stat = self.pack_path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def content_version(self) -> StorageVersion:
+        # zip keeps every member's checksum and size in its central directory
+        info = self._infos["thread.json"]
+        return info.CRC, info.file_size
+
+    def stat_version(self) -> StorageVersion:
+        return self.version()
+
+
+def get_pack_path(archive_path: Path, board: str, tid: str) -> Path:
+    return archive_path / board / f"{tid}{PACK_SUFFIX}"
+
+
+def open_thread_storage(archive_path: Path, board: str, tid: str) -> ThreadStorage:
+    pack_path = get_pack_path(archive_path, board, tid)
+    if pack_path.is_file():
+        return PackStorage(pack_path)
+    return FolderStorage(archive_path / board / tid)
+
+
+def find_thread_storages(archive_path: Path) -> Iterable[Tuple[str, ThreadStorage]]:
+    """Yield every thread of the archive, packed or not, with its board/tid id."""
+    for json_path in sorted(archive_path.glob("*/*/thread.json")):
+        folder = json_path.parent
+        if not get_pack_path(archive_path, folder.parent.name, folder.name).is_file():
+            yield f"{folder.parent.name}/{folder.name}", FolderStorage(folder)
+    for pack_path in sorted(archive_path.glob(f"*/*{PACK_SUFFIX}")):
+        if pack_path.name.startswith("."):
+            continue  # a pack still being written
+        yield f"{pack_path.parent.name}/{pack_path.stem}", PackStorage(pack_path)
+
+
+def is_thread_final(thread_data: dict) -> bool:
+    """Check if nothing about the thread, including its media, can change anymore."""
+    flags = thread_data.get("archive-chan", {})
+    archived = thread_data["posts"][0].get("archived", False)
+    return bool((archived or flags.get("404")) and flags.get("media-done"))
+
+
+def pack_thread(folder: Path, keep_folder: bool = False) -> Path:
+    """Pack every file of the thread folder, then remove the folder."""
+    pack_path = get_pack_path(folder.parent.parent, folder.parent.name, folder.name)
+    files = sorted(p for p in folder.rglob("*") if p.is_file())
+    with atomic_path(pack_path) as temp_path:
+        with ZipFile(temp_path, "w", compression=ZIP_STORED) as pack:
+            for file_path in files:
+                pack.write(file_path, file_path.relative_to(folder).as_posix())
+        with ZipFile(temp_path) as pack:
+            if pack.testzip() is not None:
+                raise RuntimeError(f"Packing {folder} produced a corrupt pack.")
+    if not keep_folder:
+        shutil.rmtree(folder)
+    return pack_path
+
+
+def get_args():
+    """Get user input from the command-line and parse it."""
+    parser = ArgumentParser(description="Pack threads that will never change again.")
+    parser.add_argument(
+        "--path",
+        default="./threads/",
+        help="Path to folder where the threads are saved.",
+        type=Path,
+    )
+    parser.add_argument(
+        "--keep_folders",
+        action="store_true",
+        help="Do not delete thread folders after packing them.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Verbose logging to stdout.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    packed = 0
+    for thread_id, storage in find_thread_storages(args.path):
+        if not isinstance(storage, FolderStorage):
+            continue
+        if not is_thread_final(storage.load_json()):
+            continue
+        pack_path = pack_thread(storage.folder, args.keep_folders)
+        packed += 1
+        if args.verbose:
+            size = os.path.getsize(pack_path)
+            print(f"Packed {thread_id} into {pack_path} ({size} bytes).")
+    print(f"{packed} threads packed.")
+
+
+if __name__ == "__main__":
+    main()
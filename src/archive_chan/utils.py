@@ -1,4 +1,13 @@
+import gzip
+import os
+import socket
+from contextlib import contextmanager
+from importlib.util import find_spec
 from pathlib import Path
+from secrets import token_hex
+from typing import Callable, Iterator, Optional
+
+COMPRESSED_SUFFIXES = {"gz": ".gz", "br": ".br"}
 
 
 def safely_create_dir(dir_path: Path):
@@ -19,3 +28,59 @@ def count_files_in_dir(
         return sum(1 for item in dir_path.iterdir() if item.is_file())
     else:  # files_only and recursive:
         return sum(1 for x in dir_path.glob("**/*") if x.is_file())
+
+
+def remove_file(file_path: Path):
+    """Delete `file_path` if it exists."""
+    try:
+        file_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def atomic_path(file_path: Path) -> Iterator[Path]:
+    """
+    Yield a temporary sibling path that is moved over `file_path` on success.
+
+    Readers, and other processes writing the same file, never see it half-written.
+    The temporary path keeps the suffix, so tools that dispatch on it still work,
+    and is unique even among hosts and containers sharing the filesystem.
+    """
+    temp_path = file_path.with_name(
+        f".{file_path.name}.{socket.gethostname()}.{os.getpid()}.{token_hex(4)}"
+        f".tmp{file_path.suffix}"
+    )
+    try:
+        yield temp_path
+        os.replace(temp_path, file_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def is_compression_available(encoding: str) -> bool:
+    """Check if files can be compressed with `encoding`; brotli is optional."""
+    return encoding != "br" or find_spec("brotli") is not None
+
+
+@contextmanager
+def compressed_writer(
+    file_path: Path, encoding: Optional[str] = None
+) -> Iterator[Callable[[bytes], object]]:
+    """Yield a function that writes to `file_path`, compressed with `encoding`."""
+    with open(file_path, "wb") as file_:
+        if encoding is None:
+            yield file_.write
+        elif encoding == "gz":
+            # no name nor timestamp in the header, so equal input gives equal files
+            with gzip.GzipFile("", "wb", fileobj=file_, mtime=0) as gzip_file:
+                yield gzip_file.write
+        elif encoding == "br":
+            import brotli
+
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+            yield lambda data: file_.write(compressor.process(data))
+            file_.write(compressor.finish())
+        else:
+            raise ValueError(f"Unknown compression: {encoding}")
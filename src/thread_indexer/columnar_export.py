@@ -0,0 +1,269 @@
+"""
+Export every archived post into a columnar, memory-mappable layout.
+
+Each numeric field is a raw little-endian file (`<field>.bin`) holding one value
+per post, so it can be opened with `numpy.memmap` without parsing anything.
+Text fields are stored as a UTF-8 blob (`<field>.blob`) plus the end offset of
+each post's string (`<field>.offsets`). `manifest.json` records the dtypes, the
+number of rows and which rows belong to which thread.
+
+Exports are incremental: threads whose data did not change since the last
+export are skipped. Rows of a thread that changed are tombstoned in the
+`live` column and its current posts are appended.
+"""
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from array import array
+from pathlib import Path
+from typing import Dict, List
+
+from archive_chan.storage import find_thread_storages
+
+from .json_index import load_json
+
+# column name -> (array typecode, numpy dtype)
+NUMERIC_COLUMNS = {
+    "no": ("q", "<i8"),
+    "resto": ("q", "<i8"),
+    "thread": ("q", "<i8"),
+    "time": ("q", "<i8"),
+    "tim": ("q", "<i8"),
+    "fsize": ("q", "<i8"),
+    "w": ("q", "<i8"),
+    "h": ("q", "<i8"),
+    "tn_w": ("q", "<i8"),
+    "tn_h": ("q", "<i8"),
+    "live": ("B", "u1"),
+}
+# column name -> (width in bytes, default value)
+FIXED_WIDTH_COLUMNS = {
+    "board": (4, ""),
+    "country": (2, "XX"),
+    "ext": (5, ""),
+}
+STRING_COLUMNS = [
+    "name",
+    "trip",
+    "id",
+    "sub",
+    "com",
+    "filename",
+    "md5",
+    "country_name",
+]
+MANIFEST = "manifest.json"
+
+
+def get_args():
+    """Get user input from the command-line and parse it."""
+    parser = ArgumentParser(description="Export archived posts to columnar files.")
+    parser.add_argument(
+        "--path",
+        default="./threads/",
+        type=Path,
+        help="Path to folder where the threads are saved.",
+    )
+    parser.add_argument(
+        "--output",
+        default="./columns/",
+        type=Path,
+        help="Path to folder where the columns will be saved.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Verbose logging to stdout.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def load_manifest(output: Path) -> dict:
+    manifest_path = output / MANIFEST
+    if not manifest_path.is_file():
+        return {"byteorder": "little", "rows": 0, "threads": {}}
+    return load_json(manifest_path)
+
+
+def save_manifest(manifest: dict, output: Path):
+    manifest["columns"] = {
+        **{name: dtype for name, (_, dtype) in NUMERIC_COLUMNS.items()},
+        **{name: f"S{width}" for name, (width, _) in FIXED_WIDTH_COLUMNS.items()},
+    }
+    manifest["strings"] = STRING_COLUMNS
+    temp_path = output / f"{MANIFEST}.tmp"
+    with open(temp_path, "w") as file_handler:
+        json.dump(manifest, file_handler, indent=2, sort_keys=True)
+    os.replace(temp_path, output / MANIFEST)
+
+
+def _truncate(file_path: Path, size: int):
+    with open(file_path, "ab") as file_handler:
+        file_handler.truncate(size)
+
+
+def _last_offset(offsets_path: Path) -> int:
+    if offsets_path.stat().st_size == 0:
+        return 0
+    with open(offsets_path, "rb") as file_handler:
+        file_handler.seek(-8, os.SEEK_END)
+        last = array("q", file_handler.read(8))
+    if sys.byteorder != "little":
+        last.byteswap()
+    return last[0]
+
+
+def discard_partial_rows(output: Path, rows: int):
+    """Cut every column back to `rows` rows, undoing an interrupted export."""
+    for name, (typecode, _) in NUMERIC_COLUMNS.items():
+        _truncate(output / f"{name}.bin", rows * array(typecode).itemsize)
+    for name, (width, _) in FIXED_WIDTH_COLUMNS.items():
+        _truncate(output / f"{name}.bin", rows * width)
+    for name in STRING_COLUMNS:
+        offsets_path = output / f"{name}.offsets"
+        _truncate(offsets_path, rows * 8)
+        _truncate(output / f"{name}.blob", _last_offset(offsets_path))
+
+
+def _tofile(values: array, file_handler):
+    if sys.byteorder != "little":
+        values.byteswap()
+    values.tofile(file_handler)
+
+
+def append_posts(output: Path, board: str, posts: List[dict]):
+    for name, (typecode, _) in NUMERIC_COLUMNS.items():
+        if name == "thread":
+            values = array(typecode, (p.get("resto") or p["no"] for p in posts))
+        elif name == "live":
+            values = array(typecode, [1] * len(posts))
+        else:
+            values = array(typecode, (p.get(name, 0) for p in posts))
+        with open(output / f"{name}.bin", "ab") as file_handler:
+            _tofile(values, file_handler)
+    for name, (width, default) in FIXED_WIDTH_COLUMNS.items():
+        if name == "board":
+            values = [board] * len(posts)
+        else:
+            values = [p.get(name, default) for p in posts]
+        encoded = b"".join(
+            v.encode("utf-8")[:width].ljust(width, b"\0") for v in values
+        )
+        with open(output / f"{name}.bin", "ab") as file_handler:
+            file_handler.write(encoded)
+    for name in STRING_COLUMNS:
+        offsets_path = output / f"{name}.offsets"
+        offset = _last_offset(offsets_path)
+        offsets = array("q")
+        with open(output / f"{name}.blob", "ab") as blob:
+            for post in posts:
+                encoded = post.get(name, "").encode("utf-8")
+                blob.write(encoded)
+                offset += len(encoded)
+                offsets.append(offset)
+        with open(offsets_path, "ab") as file_handler:
+            _tofile(offsets, file_handler)
+
+
+def tombstone_rows(output: Path, start: int, count: int):
+    with open(output / "live.bin", "r+b") as file_handler:
+        file_handler.seek(start)
+        file_handler.write(bytes(count))
+
+
+def export(archive_path: Path, output: Path, verbose: bool = False) -> Dict[str, int]:
+    """Bring the columns at `output` up to date with the threads at `archive_path`."""
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output)
+    discard_partial_rows(output, manifest["rows"])
+    stats = {"exported": 0, "skipped": 0}
+    for thread_id, storage in find_thread_storages(archive_path):
+        previous = manifest["threads"].get(thread_id)
+        stat = list(storage.stat_version())
+        if previous is not None and previous.get("stat") == stat:
+            stats["skipped"] += 1
+            continue
+        # thumbnails and packing change the storage, but not the posts
+        version = list(storage.content_version())
+        if previous is not None and previous["version"] == version:
+            previous["stat"] = stat
+            stats["skipped"] += 1
+            continue
+        posts = storage.load_json()["posts"]
+        append_posts(output, thread_id.split("/")[0], posts)
+        if previous is not None:
+            tombstone_rows(output, previous["start"], previous["count"])
+        manifest["threads"][thread_id] = {
+            "start": manifest["rows"],
+            "count": len(posts),
+            "version": version,
+            "stat": stat,
+        }
+        manifest["rows"] += len(posts)
+        stats["exported"] += 1
+        if verbose:
+            print(f"Exported {len(posts)} posts from {thread_id}.")
+    save_manifest(manifest, output)
+    return stats
+
+
+class Columns:
+    """
+    Memory-mapped view of an export; needs numpy.
+
+    `columns["time"]` is a numpy array with one entry per row and
+    `columns.text("com", row)` decodes a single string. Rows whose `live`
+    value is 0 belong to outdated copies of a thread and should be masked out.
+    """
+
+    def __init__(self, output: Path):
+        import numpy
+
+        self._numpy = numpy
+        self.output = Path(output)
+        self.manifest = load_manifest(output)
+        self._cache: Dict[str, object] = {}
+
+    def _memmap(self, file_name: str, dtype: str):
+        if file_name not in self._cache:
+            if self.manifest["rows"]:
+                array_ = self._numpy.memmap(
+                    self.output / file_name, dtype=dtype, mode="r"
+                )
+            else:
+                # numpy refuses to map empty files
+                array_ = self._numpy.empty(0, dtype=dtype)
+            self._cache[file_name] = array_
+        return self._cache[file_name]
+
+    def __getitem__(self, name: str):
+        return self._memmap(f"{name}.bin", self.manifest["columns"][name])
+
+    def offsets(self, name: str):
+        return self._memmap(f"{name}.offsets", "<i8")
+
+    def text(self, name: str, row: int) -> str:
+        offsets = self.offsets(name)
+        start = offsets[row - 1] if row else 0
+        with open(self.output / f"{name}.blob", "rb") as file_handler:
+            file_handler.seek(start)
+            return file_handler.read(offsets[row] - start).decode("utf-8")
+
+
+def main():
+    args = get_args()
+    if not args.path.is_dir():
+        print(f"No threads were found at {str(args.path)!r}.")
+        exit()
+    stats = export(args.path, args.output, args.verbose)
+    print(
+        f"{stats['exported']} threads exported, {stats['skipped']} unchanged; "
+        f"columns saved to {str(args.output)!r}."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import json
 from argparse import ArgumentParser
 from pathlib import Path
-from typing import Iterable
+
+from archive_chan.storage import find_thread_storages
 
 
 def get_args():
@@ -23,10 +24,6 @@ def get_args():
     return args
 
 
-def find_all_thread_jsons(folder_path: Path) -> Iterable[Path]:
-    return folder_path.rglob("*.json")
-
-
 def load_json(json_path: Path) -> dict:
     with open(json_path) as file_handler:
         return json.load(file_handler)
@@ -41,21 +38,16 @@ def save_json(obj: dict, json_path: Path):
         return json.dump(obj, file_handler, indent=4, sort_keys=True)
 
 
-def get_thread_id_from_json_path(json_path: Path) -> str:
-    return f"{json_path.parent.parent.name}/{json_path.parent.name}"
-
-
 def main():
     args = get_args()
-    threads = list(find_all_thread_jsons(args.path))
+    threads = list(find_thread_storages(args.path))
     if not threads:
         print(f"No threads were found at {args.path!r}.")
         exit()
     else:
         print(f"{len(threads)} were found.")
-    jsons = map(load_json, threads)
-    semantic_urls = map(get_semantic_url, jsons)
-    thread_ids = map(get_thread_id_from_json_path, threads)
+    thread_ids = [thread_id for thread_id, _ in threads]
+    semantic_urls = (get_semantic_url(storage.load_json()) for _, storage in threads)
     index = dict(zip(thread_ids, semantic_urls))
     save_json(index, args.output)
     print(f"Index saved to {args.output!r}.")
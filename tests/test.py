@@ -1,4 +1,42 @@
-from archive_chan.extractors import FourChanAPIE
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+from array import array
+from functools import partial
+from pathlib import Path
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import pytest
+
+from archive_chan import archiver
+from archive_chan.archiver import claim_work, run_stage, work_on_run
+from archive_chan.extractors import Extractor, FourChanAPIE
+from archive_chan.extractors.extractor import minify_html
+from archive_chan.journal import MAX_RETRY_ATTEMPTS, Journal, LeaseHeartbeat
+from archive_chan.params import get_args
+from archive_chan.profiling import StackSampler, merge_profiles
+from archive_chan.scheduler import ThreadListing, prioritize
+from archive_chan.server import ByteLRUCache, create_app
+from archive_chan.storage import (
+    FolderStorage,
+    PackStorage,
+    find_thread_storages,
+    pack_thread,
+)
+from archive_chan.utils import atomic_path
+from thread_indexer.columnar_export import export
+
+
+def make_args(path, **options):
+    """Arguments of `archive-chan <thread> --path <path>`, with `options` on top."""
+    args = get_args(["g", "--path", str(path)])
+    vars(args).update(options)
+    return args
 
 
 def test_url_parser():
@@ -10,3 +48,481 @@ def test_url_parser():
     assert thread_id == thread.tid
     assert thread_board == thread.board
     assert thread_url_4chan == thread.url
+
+
+def test_extractor_registry():
+    url = "https://boards.4chan.org/g/thread/79745590#p79745591"
+    class_, thread = Extractor.match_url(url)
+    assert class_ is FourChanAPIE
+    assert (thread.board, thread.tid) == ("g", "79745590")
+    assert Extractor.match_url("https://example.com/g/thread/1") is None
+
+
+def test_cli_does_not_import_heavy_dependencies():
+    code = (
+        "import sys, archive_chan.archiver;"
+        "print([m for m in ('flask', 'requests', 'superjson') if m in sys.modules])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    assert output.stdout.strip() == "[]"
+
+
+def test_backlinks():
+    quote = '<a href="#p{0}" class="quotelink">&gt;&gt;{0}</a>'
+    posts = [
+        {"no": 1, "time": 1},
+        {"no": 2, "time": 2, "com": quote.format(1)},
+        {"no": 3, "time": 3, "com": quote.format(2) + quote.format(2)},
+        {"no": 4, "time": 4, "com": quote.format(1) + quote.format(2)},
+    ]
+    replies = [FourChanAPIE._assemble_Reply_from_post(p, "a") for p in posts]
+    FourChanAPIE._collect_backlinks(replies)
+    assert [r.backlinks for r in replies] == [[2, 4], [3, 4], [], []]
+    FourChanAPIE._link_quotes_across_pages(
+        replies[3], {2: "index.html", 3: "index.html", 4: "index-2.html"}
+    )
+    assert 'href="#p1"' in replies[3].com
+    assert 'href="index.html#p2"' in replies[3].com
+
+
+def test_columnar_export(tmp_path, monkeypatch):
+    thread_folder = tmp_path / "threads" / "g" / "1"
+    thread_folder.mkdir(parents=True)
+    posts = [
+        {"no": 1, "time": 10, "com": "first", "country": "BR", "fsize": 5},
+        {"no": 2, "resto": 1, "time": 20, "com": "Ωmega"},
+    ]
+    json_path = thread_folder / "thread.json"
+    json_path.write_text(json.dumps({"posts": posts}))
+    output = tmp_path / "columns"
+    assert export(tmp_path / "threads", output) == {"exported": 1, "skipped": 0}
+    assert export(tmp_path / "threads", output) == {"exported": 0, "skipped": 1}
+    # a rewrite with the same posts is compared by content once, then by stat
+    json_path.write_text(json.dumps({"posts": posts}))
+    assert export(tmp_path / "threads", output) == {"exported": 0, "skipped": 1}
+    with monkeypatch.context() as patch:
+        patch.setattr(FolderStorage, "read_bytes", None)  # any read would fail
+        assert export(tmp_path / "threads", output) == {"exported": 0, "skipped": 1}
+
+    posts.append({"no": 3, "resto": 1, "time": 30})
+    json_path.write_text(json.dumps({"posts": posts}))
+    stat = json_path.stat()
+    os.utime(json_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert export(tmp_path / "threads", output)["exported"] == 1
+
+    def column(name, typecode="q"):
+        return list(array(typecode, (output / name).read_bytes()))
+
+    assert column("no.bin") == [1, 2, 1, 2, 3]
+    assert column("thread.bin") == [1, 1, 1, 1, 1]
+    assert column("live.bin", "B") == [0, 0, 1, 1, 1]
+    assert (output / "country.bin").read_bytes() == b"BRXX" + b"BRXXXX"
+    offsets = column("com.offsets")
+    blob = (output / "com.blob").read_bytes()
+    assert blob[offsets[2] : offsets[3]].decode("utf-8") == "Ωmega"
+    assert offsets[4] == offsets[3]
+
+    # neither thumbnails nor packing change the posts
+    (thread_folder / "thumbs").mkdir()
+    (thread_folder / "thumbs" / "1s.jpg").write_bytes(b"")
+    assert export(tmp_path / "threads", output)["exported"] == 0
+    pack_thread(thread_folder)
+    assert export(tmp_path / "threads", output) == {"exported": 0, "skipped": 1}
+    assert len(column("no.bin")) == 5
+
+
+def test_byte_lru_cache():
+    cache = ByteLRUCache(max_bytes=10)
+    cache.put("a", (1, 1), b"12345")
+    cache.put("b", (1, 1), b"12345")
+    assert cache.get("a", (1, 1)) == b"12345"
+    cache.put("c", (1, 1), b"123")
+    # "b" was the least recently used entry
+    assert cache.get("b", (1, 1)) is None
+    assert cache.get("a", (2, 1)) is None
+    assert cache.size == 3
+
+
+def test_server(tmp_path):
+    thread_folder = tmp_path / "threads" / "g" / "1"
+    (thread_folder / "media").mkdir(parents=True)
+    (thread_folder / "media" / "2.jpg").write_bytes(bytes(range(100)))
+    (thread_folder / "thumbs").mkdir()
+    (thread_folder / "thumbs" / "2s.jpg").write_bytes(bytes(10))
+    posts = [
+        {"no": 1, "time": 1, "sub": "first"},
+        {"no": 2, "time": 2, "tim": 2, "ext": ".jpg", "tn_w": 125, "tn_h": 100},
+    ]
+    (thread_folder / "thread.json").write_text(json.dumps({"posts": posts}))
+    assets = tmp_path / "assets"
+    shutil.copytree(Path(__file__).parent.parent / "assets", assets)
+    with gzip.open(assets / "css" / "styles.css.gz", "wb") as compressed:
+        compressed.write((assets / "css" / "styles.css").read_bytes())
+    args = make_args(tmp_path / "threads", assets=assets, cache_size=1)
+    client = create_app(args).test_client()
+
+    response = client.get("/g/1/")
+    assert response.status_code == 200
+    assert b"first" in response.data
+    assert b'<img src="thumbs/2s.jpg" loading="lazy"' in response.data
+    assert b'href="media/2.jpg"' in response.data
+    assert client.get("/g/1/thumbs/2s.jpg").data == bytes(10)
+    assert client.get("/g/1/index-2.html").status_code == 404
+    assert client.get("/g/2/").status_code == 404
+
+    response = client.get("/g/1/media/2.jpg", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == bytes(range(10, 20))
+
+    response = client.get("/assets/css/styles.css", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.mimetype == "text/css"
+
+    # packed threads are served from inside their pack
+    pack_thread(thread_folder)
+    assert b"first" in client.get("/g/1/").data
+    response = client.get("/g/1/media/2.jpg", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == bytes(range(10, 20))
+    response = client.get("/g/1/media/2.jpg")
+    assert (response.data, response.mimetype) == (bytes(range(100)), "image/jpeg")
+    assert client.get("/g/1/thumbs/2s.jpg").data == bytes(10)
+
+
+def test_journal_resume_and_dead_letters(tmp_path):
+    journal = Journal(tmp_path / "journal.sqlite3")
+    urls = [
+        "https://boards.4chan.org/g/thread/1",
+        "https://boards.4chan.org/g/thread/2",
+    ]
+    run_id, run_urls = journal.start_run("g", lambda: urls)
+    assert run_urls == urls
+    journal.record(run_id, urls[0], "text")
+    failed_files = ["https://i.4cdn.org/g/3.jpg"]
+    journal.record(run_id, urls[1], "media", "RuntimeError()", failed_files)
+
+    # an interrupted run is resumed without listing the threads again
+    resumed_id, resumed_urls = journal.start_run("g", lambda: [])
+    assert (resumed_id, resumed_urls) == (run_id, urls)
+    assert journal.claim(run_id, "text", urls, "worker", 10) == [urls[1]]
+    assert journal.count_dead_letters() == (1, 1)
+    # the first retry only happens after a backoff
+    assert journal.due_dead_letters() == []
+
+    # runs that were interrupted too long ago are not resumed
+    assert journal.start_run("g", lambda: [], max_age=60)[0] == run_id
+    journal.connection.execute("UPDATE runs SET started = started - 120")
+    fresh_id, fresh_urls = journal.start_run("g", lambda: urls[:1], max_age=60)
+    assert (fresh_id, fresh_urls) == (run_id + 1, urls[:1])
+
+    journal.record(None, urls[1], "media")
+    assert journal.count_dead_letters() == (0, 0)
+    journal.finish_run(run_id)
+    assert journal.start_run("g", lambda: [])[0] != run_id
+
+
+def test_journal_leases(tmp_path):
+    urls = [f"https://boards.4chan.org/g/thread/{i}" for i in range(5)]
+    first = Journal(tmp_path / "journal.sqlite3")
+    second = Journal(tmp_path / "journal.sqlite3")
+    run_id, _ = first.start_run("g", lambda: urls)
+    assert second.start_run("g", lambda: [])[0] == run_id
+
+    claimed = first.claim(run_id, "text", urls, "host:1", 3)
+    assert claimed == urls[:3]
+    assert second.claim(run_id, "text", urls, "host:2", 3) == urls[3:]
+    assert second.claim(run_id, "text", urls, "host:2", 3) == []
+    # media waits for the text stage of each thread
+    assert second.claim(run_id, "media", urls, "host:2", 3, after="text") == []
+    for url in claimed:
+        first.record(run_id, url, "text")
+    assert second.claim(run_id, "media", urls, "host:2", 5, after="text") == claimed
+    with LeaseHeartbeat(first, "host:1", interval=0.01):
+        pass
+    assert not first.is_run_complete(run_id, ["text", "media"], urls)
+
+    # runs started with other input still skip the threads being worked on
+    other_id, _ = second.start_run("g -a", lambda: urls[::-1])
+    assert second.claim(other_id, "text", urls[::-1], "host:3", 5) == urls[2::-1]
+    first.record(run_id, urls[0], "media")
+    assert second.claim(other_id, "media", urls, "host:3", 5) == [urls[0], *urls[3:]]
+    assert second.lease("media", urls, "host:4") == []
+
+
+def test_journal_failed_stages_hold_back_later_ones(tmp_path):
+    journal = Journal(tmp_path / "journal.sqlite3")
+    urls = [f"https://boards.4chan.org/g/thread/{i}" for i in range(3)]
+    run_id, _ = journal.start_run("g", lambda: urls)
+    stages = ["text", "media"]
+    journal.record(run_id, urls[0], "text", "RuntimeError()")
+    journal.record(run_id, urls[1], "text", "ThreadGoneError()", final=True)
+    journal.record(run_id, urls[2], "text")
+    assert journal.claim(run_id, "media", urls, "worker", 10, after="text") == [urls[2]]
+    journal.record(run_id, urls[2], "media")
+    assert journal.is_run_complete(run_id, stages, urls)
+    # final errors are not retried, and the others only so many times
+    assert journal.count_dead_letters() == (1, 0)
+    for _ in range(MAX_RETRY_ATTEMPTS - 1):
+        journal.record(None, urls[0], "text", "RuntimeError()")
+    assert journal.count_dead_letters() == (0, 0)
+
+
+def test_downloads_are_claimed_before_renders(tmp_path):
+    journal = Journal(tmp_path / "journal.sqlite3")
+    urls = [f"https://boards.4chan.org/g/thread/{i}" for i in range(3)]
+    run_id, _ = journal.start_run("g", lambda: urls)
+    journal.record(run_id, urls[0], "text")
+    stages = ["text", "render"]
+    assert claim_work(journal, run_id, urls, stages, "host:1", 1) == [("text", urls[1])]
+    assert claim_work(journal, run_id, urls, stages, "host:1", 5) == [
+        ("text", urls[2]),
+        ("render", urls[0]),
+    ]
+
+
+def test_processes_sharing_a_run_never_duplicate_work(tmp_path, monkeypatch):
+    urls = [f"https://boards.4chan.org/g/thread/{i}" for i in range(12)]
+    stages = ["text", "media", "render"]
+    calls = tmp_path / "calls.log"
+
+    def fake_stage(stage, extractor):
+        with open(calls, "a") as log:  # appends of a line are atomic
+            log.write(f"{stage} {extractor.url}\n")
+        sleep(0.01)
+
+    def fake_extractor(url):
+        return SimpleNamespace(url=url, failed_downloads=[])
+
+    monkeypatch.setattr(archiver, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(archiver, "choose_extractor", fake_extractor)
+    for stage in stages:
+        monkeypatch.setitem(archiver.STAGES, stage, partial(fake_stage, stage))
+
+    def archive():
+        journal = Journal(tmp_path / "journal.sqlite3")
+        run_id, run_urls = journal.start_run("g", lambda: urls)
+        work_on_run(journal, run_id, run_urls, stages, False, threads=2)
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=archive) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    lines = calls.read_text().splitlines()
+    assert sorted(lines) == sorted(f"{stage} {url}" for stage in stages for url in urls)
+
+
+def test_unexpected_stage_errors_are_dead_lettered(tmp_path, monkeypatch):
+    args = make_args(tmp_path)
+    monkeypatch.setattr(
+        archiver, "choose_extractor", partial(Extractor.from_url, args=args)
+    )
+    (tmp_path / "g" / "1").mkdir(parents=True)
+    (tmp_path / "g" / "1" / "thread.json").write_text('{"posts": [')  # truncated
+    journal = Journal(tmp_path / "journal.sqlite3")
+    run_id, _ = journal.start_run("g", lambda: [])
+    urls = [
+        "https://boards.4chan.org/g/thread/1",
+        "https://boards.4chan.org/zz/thread/2",
+    ]
+    for url in urls:
+        assert run_stage("text", journal, run_id, url) is not None
+    assert journal.count_dead_letters() == (2, 0)
+
+
+def test_atomic_path(tmp_path):
+    file_path = tmp_path / "thread.json"
+    file_path.write_text("old")
+    try:
+        with atomic_path(file_path) as temp_path:
+            assert temp_path.suffix == ".json"
+            temp_path.write_text("half")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert file_path.read_text() == "old"
+    with atomic_path(file_path) as temp_path:
+        temp_path.write_text("new")
+    assert file_path.read_text() == "new"
+    assert list(tmp_path.iterdir()) == [file_path]
+
+
+def thumbnail_extractor(tmp_path, monkeypatch, status, **options):
+    """An extractor for a thread with one .webm, whose CDN answers `status`."""
+    thread_folder = tmp_path / "g" / "1"
+    thread_folder.mkdir(parents=True)
+    posts = [{"no": 1, "time": 1, "tim": 5, "ext": ".webm"}, {"no": 2, "time": 2}]
+    (thread_folder / "thread.json").write_text(json.dumps({"posts": posts}))
+    extractor = Extractor.from_url(
+        "https://boards.4chan.org/g/thread/1", make_args(tmp_path, **options)
+    )
+    fetched = []
+
+    def download_file(url, file_path, *args):
+        fetched.append(url)
+        if status == 200:
+            file_path.write_bytes(b"jpg")
+        else:
+            urls = (
+                extractor.missing_files if status == 404 else extractor.failed_downloads
+            )
+            urls.append(url)
+
+    monkeypatch.setattr(extractor, "download_file", download_file)
+    return extractor, fetched
+
+
+def test_existing_thumbnails_are_skipped(tmp_path, monkeypatch):
+    extractor, fetched = thumbnail_extractor(tmp_path, monkeypatch, 500)
+    (tmp_path / "g" / "1" / "thumbs").mkdir()
+    (tmp_path / "g" / "1" / "thumbs" / "5s.jpg").write_bytes(b"")
+    extractor.download_thread_thumbnails()
+    assert fetched == []
+
+
+def test_thumbnails_fall_back_to_the_cdn(tmp_path, monkeypatch):
+    # with local_thumbnails, a .webm cannot be shrunk locally, so it is fetched
+    extractor, fetched = thumbnail_extractor(
+        tmp_path, monkeypatch, 200, local_thumbnails=True
+    )
+    extractor.download_thread_thumbnails()
+    assert fetched == ["https://i.4cdn.org/g/5s.jpg"]
+    assert (tmp_path / "g" / "1" / "thumbs" / "5s.jpg").read_bytes() == b"jpg"
+
+
+def test_thumbnails_gone_from_the_cdn_do_not_fail_the_stage(tmp_path, monkeypatch):
+    extractor, _ = thumbnail_extractor(tmp_path, monkeypatch, 404)
+    extractor.download_thread_thumbnails()
+    assert extractor.missing_files == ["https://i.4cdn.org/g/5s.jpg"]
+    extractor.render_thread()
+    html = (tmp_path / "g" / "1" / "index.html").read_text()
+    # the page shows the full file where the thumbnail would be
+    assert "media/5.webm" in html and "thumbs/5s.jpg" not in html
+
+    extractor, _ = thumbnail_extractor(tmp_path / "other", monkeypatch, 500)
+    with pytest.raises(RuntimeError):
+        extractor.download_thread_thumbnails()
+
+
+def test_pack_thread(tmp_path):
+    archive = tmp_path / "threads"
+    thread_folder = archive / "g" / "1"
+    (thread_folder / "media").mkdir(parents=True)
+    (thread_folder / "media" / "2.jpg").write_bytes(bytes(range(100)))
+    posts = [
+        {"no": 1, "time": 1, "archived": 1, "sub": "packed"},
+        {"no": 2, "time": 2, "tim": 2, "ext": ".jpg"},
+    ]
+    thread_data = {"posts": posts, "archive-chan": {"media-done": True}}
+    (thread_folder / "thread.json").write_text(json.dumps(thread_data))
+
+    pack_path = pack_thread(thread_folder)
+    assert not thread_folder.exists()
+    assert [thread_id for thread_id, _ in find_thread_storages(archive)] == ["g/1"]
+    storage = PackStorage(pack_path)
+    assert storage.load_json() == thread_data
+    assert storage.list("media") == ["2.jpg"]
+
+    args = make_args(
+        archive, assets=Path(__file__).parent.parent / "assets", cache_size=1
+    )
+    extractor = Extractor.from_url("https://boards.4chan.org/g/thread/1", args)
+    # finished threads are left alone and their folder is not recreated
+    extractor.download_thread_data()
+    extractor.download_thread_media()
+    extractor.download_thread_thumbnails()
+    extractor.render_thread()
+    assert not thread_folder.exists()
+
+    client = create_app(args).test_client()
+    assert b"packed" in client.get("/g/1/").data
+    response = client.get("/g/1/media/2.jpg", headers={"Range": "bytes=90-"})
+    assert response.status_code == 206
+    assert response.data == bytes(range(90, 100))
+
+
+def test_prioritize_threads_by_expiry():
+    now = 100_000
+    # in bump order, as in the catalog
+    catalog = {
+        "pinned": {"time": 0, "last_modified": 0, "sticky": 1},
+        "fresh": {"time": now - 30, "last_modified": now - 30},
+        "quiet": {"time": now - 3000, "last_modified": now - 2000},
+        # sank further, but gets a reply every quarter of an hour or so
+        "lively": {"time": now - 3000, "last_modified": now - 2500, "replies": 3},
+        # replies past the bump limit changed last_modified, but not its place
+        "capped": {"time": now - 9000, "last_modified": now - 60, "bumplimit": 1},
+        # at the bottom of the board
+        "sinking": {"time": now - 9000, "last_modified": now - 3600},
+    }
+    listings = [
+        ThreadListing.from_catalog(url, thread, position)
+        for position, (url, thread) in enumerate(catalog.items())
+    ]
+    ordered = [listing.url for listing in prioritize(listings, now)]
+    assert ordered == ["sinking", "capped", "quiet", "lively", "fresh", "pinned"]
+
+
+def spin(seconds):
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        pass
+
+
+def test_profile_samples_are_merged(tmp_path):
+    for stage in ["text", "render", "render"]:
+        with StackSampler(tmp_path, [stage, "/g/1"]):
+            spin(0.1)
+    folded_path = merge_profiles(tmp_path)
+    stacks = dict(line.rsplit(" ", 1) for line in folded_path.read_text().splitlines())
+    frame = f"spin (test.py:{spin.__code__.co_firstlineno})"
+    assert set(stacks) == {f"text;/g/1;{frame}", f"render;/g/1;{frame}"}
+    assert int(stacks[f"render;/g/1;{frame}"]) > int(stacks[f"text;/g/1;{frame}"])
+    hotspots = (tmp_path / "hotspots.txt").read_text()
+    assert "[render]" in hotspots and "render /g/1" in hotspots
+    assert not list((tmp_path / "parts").iterdir())
+
+
+def test_render_streams_minified_and_compressed_pages(tmp_path):
+    assert "".join(minify_html(["<a>\n  ", "  <b>\n\n", "\t</b>  \n", " </a>"])) == (
+        "<a>\n<b>\n</b>\n</a>"
+    )
+    thread_folder = tmp_path / "g" / "1"
+    thread_folder.mkdir(parents=True)
+    posts = [{"no": 1, "time": 1, "sub": "streamed"}, {"no": 2, "time": 2}]
+    (thread_folder / "thread.json").write_text(json.dumps({"posts": posts}))
+    args = make_args(tmp_path, minify_html=True, compress_html=["gz"])
+    extractor = Extractor.from_url("https://boards.4chan.org/g/thread/1", args)
+    extractor.render_thread()
+    html = (thread_folder / "index.html").read_bytes()
+    assert b"streamed" in html and b"\n " not in html
+    assert gzip.decompress((thread_folder / "index.html.gz").read_bytes()) == html
+    context = extractor.page_contexts()["index.html"]
+    assert "".join(minify_html([extractor.render_html(**context)])) == html.decode()
+    assert sorted(p.name for p in thread_folder.iterdir()) == [
+        "index.html",
+        "index.html.gz",
+        "thread.json",
+    ]
+    # pages rendered without compression do not leave an outdated .gz behind
+    args.compress_html = []
+    Extractor.from_url("https://boards.4chan.org/g/thread/1", args).render_thread()
+    assert not (thread_folder / "index.html.gz").exists()
+
+    # neither do pages of a render with fewer posts per page
+    posts.append({"no": 3, "time": 3})
+    (thread_folder / "thread.json").write_text(json.dumps({"posts": posts}))
+    args.posts_per_page = 1
+    args.compress_html = ["gz"]
+    Extractor.from_url("https://boards.4chan.org/g/thread/1", args).render_thread()
+    assert (thread_folder / "index-2.html.gz").exists()
+    args.posts_per_page = None
+    Extractor.from_url("https://boards.4chan.org/g/thread/1", args).render_thread()
+    assert sorted(p.name for p in thread_folder.glob("index*")) == [
+        "index.html",
+        "index.html.gz",
+    ]